@@ -1,14 +1,24 @@
 import os
+import re
 import sys
+import uuid
 import base64
 import logging
 import mimetypes
+import tempfile
 import subprocess
+from lxml import etree
 from pathlib import Path
-from lxml import etree, html
+from concurrent.futures import ThreadPoolExecutor
 home_dir = os.path.expanduser("~")
 logger = logging.getLogger(__name__)
 
+# bytes read at a time when embedding an image, a multiple of 3 for base64
+CHUNK_SIZE = 3 * 256 * 1024
+
+# concurrent image encoders used by imbed_images
+EMBED_WORKERS = 4
+
 
 def snapshot(url, saveto, container_dir=None):
     chromium_sif = check_container_path(container_dir)
@@ -28,29 +38,97 @@ def snapshot(url, saveto, container_dir=None):
         sys.exit(1)
 
 def imbed_images(infile, outfile=None):
+    '''
+    Write a copy of an HTML report with every <object> image embedded.
+    SVGs are inlined and other images become base64 data URIs.
+
+    The report itself is small and is parsed with lxml, with every <object>
+    swapped for a placeholder. Each distinct image is encoded once, keyed by
+    path and mtime, on a pool of workers into a spool file, and the spooled
+    images are copied in chunks over the placeholders as the report is
+    written, so memory use does not grow with the number or size of the
+    images.
+    '''
     infile = Path(infile)
     if not outfile:
         outfile = infile.with_stem(f'{infile.stem}-imbedded_images')
-    os.chdir(infile.parent)
     logger.info(f'reading {infile}')
-    with open(infile) as fo:
-        content = fo.read().encode('utf-8')
-    root = etree.HTML(content)
-    for obj in root.xpath('//object'):
-        filename = obj.attrib['data']
-        mimetype = mimetypes.guess_type(filename)[0]
-        with open(filename, 'rb') as image_file:
-            content = image_file.read()
-            if mimetype == 'image/svg+xml':
-                svg = etree.XML(content)
-                obj.getparent().replace(obj, svg)
+    with open(infile, 'rb') as fo:
+        root = etree.HTML(fo.read(), parser=etree.HTMLParser(encoding='utf-8'))
+
+    marker = uuid.uuid4().hex
+    with tempfile.TemporaryDirectory() as spool, ThreadPoolExecutor(max_workers=EMBED_WORKERS) as pool:
+        encoded = dict()
+        images = list()
+        for obj in root.xpath('//object[@data]'):
+            source = infile.parent / obj.attrib['data']
+            key = asset_key(source)
+            if key not in encoded:
+                target = os.path.join(spool, str(len(encoded)))
+                encoded[key] = pool.submit(encode, source, target)
+            placeholder = f'{marker}:{len(images)}'
+            if mimetypes.guess_type(str(source))[0] == 'image/svg+xml':
+                comment = etree.Comment(placeholder)
+                comment.tail = obj.tail
+                obj.getparent().replace(obj, comment)
             else:
-                content = base64.b64encode(content).decode('utf-8')
-                newdata = f'data:{mimetype};base64,{content}'
-                obj.attrib['data'] = newdata
-    logger.info(f'writing {outfile}')
-    with open(outfile, 'wb') as fo:
-        fo.write(etree.tostring(root))
+                obj.attrib['data'] = placeholder
+            images.append(encoded[key])
+        logger.info(f'embedding {len(images)} images from {len(encoded)} files')
+
+        # split the report into the text between placeholders and image indexes
+        parts = re.split(f'(?:<!--)?{marker}:(\\d+)(?:-->)?', etree.tostring(root).decode('utf-8'))
+        logger.info(f'writing {outfile}')
+        with open(outfile, 'w', encoding='utf-8') as out:
+            out.write(parts[0])
+            for index,text in zip(parts[1::2], parts[2::2]):
+                spooled,mimetype = images[int(index)].result()
+                if mimetype != 'image/svg+xml':
+                    out.write(f'data:{mimetype};base64,')
+                copy_spooled(spooled, out)
+                out.write(text)
+
+def asset_key(source):
+    '''
+    Identify an image by its real path and modification time
+    '''
+    source = os.path.realpath(source)
+    return source, os.stat(source).st_mtime_ns
+
+def encode(source, target):
+    '''
+    Encode an image into a spool file the way it will be embedded and
+    return the spool file with the image mime type
+    '''
+    mimetype = mimetypes.guess_type(str(source))[0]
+    with open(target, 'w', encoding='utf-8') as out:
+        if mimetype == 'image/svg+xml':
+            write_svg(source, out)
+        else:
+            write_base64(source, out)
+    return target, mimetype
+
+def copy_spooled(spooled, out):
+    with open(spooled, encoding='utf-8') as fo:
+        for chunk in iter(lambda: fo.read(CHUNK_SIZE), ''):
+            out.write(chunk)
+
+def write_svg(source, out):
+    '''
+    Parse an SVG with lxml and write its root element, which leaves out the
+    XML declaration and doctype that are not valid inside HTML
+    '''
+    svg = etree.parse(str(source)).getroot()
+    out.write(etree.tostring(svg, encoding='unicode'))
+
+def write_base64(source, out):
+    '''
+    Base64 encode a file into the output one chunk at a time. Chunks are a
+    multiple of 3 bytes, so the encoded chunks concatenate without padding.
+    '''
+    with open(source, 'rb') as fo:
+        for chunk in iter(lambda: fo.read(CHUNK_SIZE), b''):
+            out.write(base64.b64encode(chunk).decode('ascii'))
 
 def check_container_path(container_dir):
     if container_dir:
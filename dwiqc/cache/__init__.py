@@ -0,0 +1,238 @@
+import os
+import json
+import stat
+import uuid
+import fcntl
+import shutil
+import hashlib
+import logging
+import datetime as dt
+import collections as col
+import dwiqc.files as files
+
+logger = logging.getLogger(__name__)
+
+# outputs that are never rewritten in place and are restored as hardlinks
+# to the read-only cache entry, everything else is cloned
+LINK_SUFFIXES = ('.nii', '.nii.gz', '.h5', '.gii', '.mif')
+
+# per-run files that are never cached
+EXCLUDE_DIRS = ['logs']
+
+# provenance of the job that produced an entry, kept outside the cached tree
+PROVENANCE = os.path.join('logs', 'provenance.json')
+
+class ResultCache:
+    '''
+    Content-addressed cache of prequal and qsiprep output directories.
+
+    Entries are keyed by a hash of the staged input files, the container
+    image, and every option passed to the container. Entries are cloned
+    from the output directory and made read-only, so nothing written to the
+    output directory afterwards can change them. A hit is materialized into
+    the output directory with hardlinks or reflinks where possible.
+    '''
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def key(self, container, inputs, **params):
+        '''
+        Hash the container image digest, the contents of the input files
+        (keyed by file name) and any additional parameters
+        '''
+        sha = hashlib.sha256()
+        sha.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+        sha.update(self.container_digest(container).encode('utf-8'))
+        for name,filename in sorted(inputs.items()):
+            sha.update(f'{name}\0{digest(filename)}\n'.encode('utf-8'))
+        return sha.hexdigest()
+
+    def container_digest(self, sif):
+        '''
+        Digest of a container image. Images are several gigabytes, so the
+        digest is remembered by path, size and modification time.
+        '''
+        sif = os.path.realpath(sif)
+        st = os.stat(sif)
+        stamp = f'{st.st_size}:{st.st_mtime_ns}'
+        os.makedirs(self.root, exist_ok=True)
+        digests = os.path.join(self.root, 'containers.json')
+        with open(os.path.join(self.root, 'containers.lock'), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            known = dict()
+            if os.path.exists(digests):
+                with open(digests) as fo:
+                    known = json.load(fo)
+            if sif in known and known[sif]['stamp'] == stamp:
+                return known[sif]['digest']
+            logger.info('computing digest of container %s', sif)
+            known[sif] = {
+                'stamp': stamp,
+                'digest': digest(sif)
+            }
+            tmp = f'{digests}.{uuid.uuid4().hex}'
+            with open(tmp, 'w') as fo:
+                json.dump(known, fo, indent=2)
+            os.replace(tmp, digests)
+        return known[sif]['digest']
+
+    def contains(self, key):
+        return os.path.isdir(self.path(key))
+
+    def restore(self, key, outdir):
+        '''
+        Materialize a cache entry into outdir. Returns False on a miss.
+        '''
+        if not self.contains(key):
+            logger.info('result cache miss for %s', key)
+            # outdir is about to be regenerated, so stop sharing inodes with the entry it was restored from
+            self.unshare(outdir)
+            return False
+        logger.info('result cache hit for %s, restoring to %s', key, outdir)
+        methods = materialize(self.path(key), outdir)
+        logger.info('restored %s', summarize(methods))
+        return True
+
+    def store(self, key, outdir):
+        '''
+        Add outdir to the cache. The entry is built in a temporary
+        directory and renamed into place so readers never see a partial
+        entry.
+        '''
+        if self.contains(key):
+            logger.debug('result cache already contains %s', key)
+            return
+        entry = self.path(key)
+        tmp = os.path.join(self.root, 'tmp', uuid.uuid4().hex)
+        logger.info('storing %s in result cache as %s', outdir, key)
+        try:
+            methods = materialize(outdir, tmp, share=False)
+            if os.path.exists(os.path.join(outdir, PROVENANCE)):
+                os.makedirs(os.path.join(tmp, 'logs'), exist_ok=True)
+                shutil.copyfile(os.path.join(outdir, PROVENANCE), os.path.join(tmp, PROVENANCE))
+            freeze(tmp)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            os.rename(tmp, entry)
+            logger.info('stored %s', summarize(methods))
+        except OSError as e:
+            # another process stored the same entry first
+            if not self.contains(key):
+                raise e
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def unshare(self, outdir):
+        '''
+        Remove files from outdir that are hardlinked to the cache entry it
+        was last restored from, so that a job writing to them in place
+        cannot modify the entry. Other hardlinks are left alone.
+        '''
+        key = tracked(outdir)
+        if not key or not self.contains(key):
+            return
+        entry = self.path(key)
+        for root, dirs, filenames in os.walk(outdir):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                cached = os.path.join(entry, os.path.relpath(path, outdir))
+                if os.path.islink(path) or not os.path.isfile(cached):
+                    continue
+                if os.path.samefile(path, cached):
+                    os.remove(path)
+
+    def provenance(self, key):
+        '''
+        Provenance for outputs restored from an entry. This is the provenance
+        of the job that produced the entry, marked with the cache key. Entries
+        stored without one get the time of the restore as their start time.
+        '''
+        prov = dict()
+        fname = os.path.join(self.path(key), PROVENANCE)
+        if os.path.exists(fname):
+            with open(fname) as fo:
+                prov = json.load(fo)
+        else:
+            now = dt.datetime.now()
+            prov['start_date'] = now.strftime('%Y-%m-%d')
+            prov['start_time'] = now.strftime('%H:%M:%S')
+        prov.update({
+            'returncode': 0,
+            'cache': key
+        })
+        return prov
+
+def materialize(src, dst, share=True):
+    '''
+    Recreate the tree under src at dst, skipping excluded directories.
+    Files with LINK_SUFFIXES are hardlinked when share is set and every
+    other file is cloned. Returns the number of files materialized with
+    each method.
+    '''
+    methods = col.Counter()
+    for root, dirs, filenames in os.walk(src):
+        if root == src:
+            dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
+        outdir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(outdir, exist_ok=True)
+        # os.walk does not descend into symlinked directories, keep them as links
+        for dirname in [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            target = os.path.join(outdir, dirname)
+            if not os.path.lexists(target):
+                os.symlink(os.readlink(os.path.join(root, dirname)), target)
+                methods['symlink'] += 1
+        for filename in filenames:
+            source = os.path.join(root, filename)
+            target = os.path.join(outdir, filename)
+            if os.path.lexists(target):
+                os.remove(target)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                methods['symlink'] += 1
+            elif share and filename.endswith(LINK_SUFFIXES):
+                methods[files.link(source, target)] += 1
+            else:
+                methods[files.clone(source, target)] += 1
+                # clones of a read-only entry are independent copies
+                os.chmod(target, os.stat(target).st_mode | stat.S_IWUSR)
+    return methods
+
+def freeze(path):
+    '''
+    Remove write permission from every file under path
+    '''
+    nowrite = ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    for root, dirs, filenames in os.walk(path):
+        for filename in filenames:
+            fullfile = os.path.join(root, filename)
+            if not os.path.islink(fullfile):
+                os.chmod(fullfile, os.stat(fullfile).st_mode & nowrite)
+
+def summarize(methods):
+    return ', '.join(f'{count} files by {method}' for method,count in sorted(methods.items())) or 'no files'
+
+def digest(filename):
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as fo:
+        for chunk in iter(lambda: fo.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def track(outdir, key):
+    '''
+    Remember which cache key an output directory was built from so the
+    outputs can be stored once the job has finished
+    '''
+    logdir = os.path.join(outdir, 'logs')
+    os.makedirs(logdir, exist_ok=True)
+    with open(os.path.join(logdir, 'cache.json'), 'w') as fo:
+        json.dump({'key': key}, fo, indent=2)
+
+def tracked(outdir):
+    sidecar = os.path.join(outdir, 'logs', 'cache.json')
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as fo:
+        return json.load(fo).get('key')
@@ -0,0 +1,122 @@
+import os
+import re
+import json
+import time
+import yaxil
+import logging
+
+logger = logging.getLogger(__name__)
+
+# rows requested per page of the project catalogue
+PAGE_SIZE = 5000
+
+# experiment and scan columns requested from the XNAT search API, mapped
+# onto the keys that yaxil uses for the scans of a single session
+COLUMNS = {
+    'ID': 'session_id',
+    'label': 'session_label',
+    'project': 'session_project',
+    'subject_ID': 'subject_id',
+    'subject_label': 'subject_label',
+    'xnat:mrscandata/id': 'id',
+    'xnat:mrscandata/note': 'note',
+    'xnat:mrscandata/quality': 'quality',
+    'xnat:mrscandata/type': 'type',
+    'xnat:mrscandata/series_description': 'series_description'
+}
+
+class Catalogue:
+    '''
+    Scan metadata for every MR session in an XNAT project, fetched with a
+    few paged requests and cached on disk until it expires.
+    '''
+    def __init__(self, auth, project, cache_dir, expiry=3600):
+        self.auth = auth
+        self.project = project
+        self.expiry = expiry
+        host = re.sub(r'[^a-zA-Z0-9]', '_', re.sub(r'^https?://', '', auth.url.rstrip('/')))
+        self.filename = os.path.join(os.path.expanduser(cache_dir), f'{host}_{project}.json')
+        self.sessions = None
+        self.fresh = False
+
+    def load(self):
+        '''
+        Read the cached catalogue if it has not expired, otherwise fetch it
+        '''
+        if os.path.exists(self.filename):
+            with open(self.filename) as fo:
+                cached = json.load(fo)
+            age = time.time() - cached['created']
+            if age < self.expiry:
+                logger.info('using cached scan catalogue %s (%.0f seconds old)', self.filename, age)
+                self.sessions = cached['sessions']
+                return self.sessions
+            logger.info('scan catalogue %s has expired', self.filename)
+        return self.refresh()
+
+    def refresh(self):
+        self.sessions = self.fetch()
+        self.fresh = True
+        self.save()
+        return self.sessions
+
+    def fetch(self):
+        '''
+        Page through the scans of every MR session in the project. Paging
+        stops at a short page or at a page with no new rows, in case the
+        server ignores limit and offset.
+        '''
+        logger.info('fetching scan catalogue for project %s', self.project)
+        sessions = dict()
+        seen = set()
+        offset = 0
+        while True:
+            params = {
+                'project': self.project,
+                'xsiType': 'xnat:mrSessionData',
+                'columns': ','.join(COLUMNS.keys()),
+                'sortBy': 'ID',
+                'limit': PAGE_SIZE,
+                'offset': offset
+            }
+            r = yaxil.get(self.auth, '/data/experiments', autobox=True, fmt='json', params=params)
+            rows = r.content['ResultSet']['Result']
+            new = 0
+            for row in rows:
+                if not row.get('xnat:mrscandata/id'):
+                    continue
+                key = (row['ID'], row['xnat:mrscandata/id'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                new += 1
+                scan = {v: row.get(k, '') for k,v in COLUMNS.items()}
+                scan['ID'] = scan['id']
+                sessions.setdefault(scan['session_label'], list()).append(scan)
+            if len(rows) < PAGE_SIZE or not new:
+                break
+            offset += len(rows)
+        # keep the scan order of a single session listing
+        for scans in sessions.values():
+            scans.sort(key=lambda scan: (not scan['id'].isdigit(), int(scan['id']) if scan['id'].isdigit() else 0, scan['id']))
+        logger.info('found %s scans in %s sessions', len(seen), len(sessions))
+        return sessions
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = f'{self.filename}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump({'created': time.time(), 'sessions': self.sessions}, fo)
+        os.replace(tmp, self.filename)
+
+    def scans(self, label):
+        '''
+        Scans of a single session, fetching the catalogue again if a cached
+        copy predates the session. Returns None for an unknown session.
+        '''
+        if self.sessions is None:
+            self.load()
+        if label not in self.sessions and not self.fresh:
+            logger.info('session %s is not in the cached scan catalogue', label)
+            self.refresh()
+        return self.sessions.get(label)
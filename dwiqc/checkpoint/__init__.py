@@ -0,0 +1,216 @@
+import os
+import json
+import fcntl
+import hashlib
+import logging
+import contextlib
+from dwiqc.state import State
+from dwiqc.tasks import BaseTask
+from dwiqc.downloads import Manifest
+
+logger = logging.getLogger(__name__)
+
+# stages in the order they run and the stages each one consumes
+UPSTREAM = {
+    'prequal': [],
+    'qsiprep': [],
+    'prequal-postprocess': ['prequal'],
+    'qsiprep-postprocess': ['qsiprep'],
+    'report': ['prequal-postprocess', 'qsiprep-postprocess']
+}
+
+# input directories that dwiqc never rewrites
+INPUT_DIRS = ['dwi', 'anat']
+
+# fieldmaps are truncated and given IntendedFor in place, so they are
+# fingerprinted by the scans they were downloaded from instead
+FMAP_DIR = 'fmap'
+
+class Checkpoints:
+    '''
+    Provenance and fingerprints for every stage of a single session.
+
+    A stage is complete when its provenance file reports a returncode of
+    zero. With --resume the fingerprint of its inputs and configuration is
+    saved next to the provenance file whenever the stage is scheduled, so a
+    complete stage whose fingerprint is unchanged can be skipped.
+    '''
+    def __init__(self, args, outdirs):
+        self.args = args
+        self.outdirs = outdirs
+        self._fingerprints = dict()
+
+    def provenance(self, stage):
+        if stage in ('prequal', 'qsiprep'):
+            return os.path.join(self.outdirs[stage], 'logs', 'provenance.json')
+        if stage == 'report':
+            return os.path.join(self.outdirs['qsiprep'], 'logs', 'report-provenance.json')
+        task = stage.split('-')[0]
+        return os.path.join(self.outdirs[task], 'logs', 'postprocess-provenance.json')
+
+    def config(self, stage):
+        '''
+        Command line options and configuration files that change the
+        output of a stage
+        '''
+        args = self.args
+        config = {
+            'container_dir': args.container_dir
+        }
+        if stage == 'prequal':
+            config.update({
+                'prequal_config': digest(args.prequal_config),
+                'custom_eddy_prequal_stdev': args.custom_eddy_prequal_stdev,
+                'no_gpu': args.no_gpu
+            })
+        elif stage == 'qsiprep':
+            config.update({
+                'qsiprep_config': digest(args.qsiprep_config),
+                'custom_eddy_qsiprep': digest(args.custom_eddy_qsiprep) if args.custom_eddy_qsiprep else None,
+                'truncate_qsiprep_fmap': args.truncate_qsiprep_fmap,
+                'no_gpu': args.no_gpu
+            })
+        elif stage == 'report':
+            config.update({
+                'artifacts_dir': os.path.abspath(args.artifacts_dir),
+                'xnat_upload': args.xnat_upload
+            })
+        return config
+
+    def inputs(self):
+        '''
+        Every file in the session's diffusion and anatomical directories
+        '''
+        session = os.path.join(self.args.bids_dir, f'sub-{self.args.sub}', f'ses-{self.args.ses}')
+        files = list()
+        for dirname in INPUT_DIRS:
+            for root, dirs, filenames in os.walk(os.path.join(session, dirname)):
+                dirs.sort()
+                files.extend(os.path.join(root, f) for f in sorted(filenames) if not f.startswith('.'))
+        return files
+
+    def fieldmaps(self):
+        '''
+        Stamps of the scans the session's fieldmaps were downloaded from,
+        as recorded in the download manifest
+        '''
+        session = os.path.join(self.args.bids_dir, f'sub-{self.args.sub}', f'ses-{self.args.ses}')
+        return Manifest(session).stamps(FMAP_DIR)
+
+    def fingerprint(self, stage):
+        '''
+        Hash of a stage's configuration along with the fingerprints of the
+        stages it consumes, or the session inputs for the first stages
+        '''
+        if stage in self._fingerprints:
+            return self._fingerprints[stage]
+        sha = hashlib.sha1()
+        sha.update(json.dumps({'stage': stage, 'config': self.config(stage)}, sort_keys=True).encode('utf-8'))
+        if UPSTREAM[stage]:
+            for upstream in UPSTREAM[stage]:
+                sha.update(self.fingerprint(upstream).encode('utf-8'))
+        else:
+            for f in self.inputs():
+                sha.update(os.path.relpath(f, self.args.bids_dir).encode('utf-8'))
+                sha.update(digest(f).encode('utf-8'))
+            for key,stamp in sorted(self.fieldmaps().items()):
+                sha.update(f'{key}:{stamp}'.encode('utf-8'))
+        self._fingerprints[stage] = sha.hexdigest()
+        return self._fingerprints[stage]
+
+    def sidecar(self, stage):
+        return os.path.splitext(self.provenance(stage))[0] + '.fingerprint.json'
+
+    def record(self, stage):
+        '''
+        Save the fingerprint of a stage that is about to run and discard its
+        previous provenance, which no longer describes the saved fingerprint
+        '''
+        prov = self.provenance(stage)
+        if os.path.exists(prov):
+            os.remove(prov)
+        sidecar = self.sidecar(stage)
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        with open(sidecar, 'w') as fo:
+            json.dump({'stage': stage, 'fingerprint': self.fingerprint(stage)}, fo, indent=2)
+
+    def discard(self, stage):
+        '''
+        Remove the saved fingerprint of a stage that runs without --resume,
+        it would no longer describe the outputs
+        '''
+        sidecar = self.sidecar(stage)
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+
+    def state(self, stage):
+        return BaseTask.state(self.provenance(stage))
+
+    def unchanged(self, stage):
+        sidecar = self.sidecar(stage)
+        if not os.path.exists(sidecar):
+            return False
+        with open(sidecar) as fo:
+            return json.load(fo).get('fingerprint') == self.fingerprint(stage)
+
+    def skip(self, stages):
+        '''
+        Return the stages that can be skipped since they are complete, their
+        fingerprint is unchanged and every stage they consume was skipped too
+        '''
+        skipped = set()
+        for stage in UPSTREAM:
+            if stage not in stages:
+                continue
+            state = self.state(stage)
+            if state != State.COMPLETE:
+                logger.info('re-running %s, provenance state is %s', stage, state)
+            elif not self.unchanged(stage):
+                logger.info('re-running %s, inputs or configuration have changed', stage)
+            elif not all(upstream in skipped for upstream in UPSTREAM[stage] if upstream in stages):
+                logger.info('re-running %s, an upstream stage is re-running', stage)
+            else:
+                logger.info('skipping %s, already complete', stage)
+                skipped.add(stage)
+        return skipped
+
+def stages(sub_tasks):
+    '''
+    Every stage that runs for the requested sub tasks
+    '''
+    stages = list()
+    for task in ('prequal', 'qsiprep'):
+        if task in sub_tasks:
+            stages.extend([task, f'{task}-postprocess'])
+    if 'prequal' in sub_tasks and 'qsiprep' in sub_tasks:
+        stages.append('report')
+    return stages
+
+def digest(filename):
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as fo:
+        for chunk in iter(lambda: fo.read(1024 * 1024), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+@contextlib.contextmanager
+def provenance(prov):
+    '''
+    Record the returncode of the enclosed block in the same provenance
+    format that selfie writes, holding a lock on the file while it runs
+    '''
+    os.makedirs(os.path.dirname(prov), exist_ok=True)
+    with open(prov, 'w') as fo:
+        fcntl.lockf(fo, fcntl.LOCK_EX)
+        json.dump({'returncode': None}, fo)
+        fo.flush()
+        returncode = 1
+        try:
+            yield
+            returncode = 0
+        finally:
+            fo.seek(0)
+            fo.truncate()
+            json.dump({'returncode': returncode}, fo)
+            fo.flush()
+            fcntl.lockf(fo, fcntl.LOCK_UN)
@@ -1,4 +1,7 @@
 from . import get
 from . import process
 from . import tandem
+from . import sweep
+from . import batch
+from . import postprocess
 from . import install_containers
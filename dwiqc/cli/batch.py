@@ -0,0 +1,182 @@
+import os
+import re
+import csv
+import sys
+import copy
+import glob
+import yaml
+import yaxil
+import logging
+import functools
+import collections as col
+from executors.models import JobArray
+from dwiqc.layout import Index
+import dwiqc.checkpoint as checkpoint
+import dwiqc.pipeline as pipelines
+from dwiqc.pipeline import Pipeline
+import dwiqc.cli.process as process
+
+
+logger = logging.getLogger(__name__)
+
+def do(args):
+    if args.insecure:
+        logger.warning('disabling ssl certificate verification')
+        yaxil.CHECK_CERTIFICATE = False
+
+    # create a single job executor, job array and pipeline shared by every session
+    E = process.get_executor(args)
+    jarray = JobArray(E)
+    pipeline = Pipeline(jarray)
+
+    if args.work_dir:
+        os.environ['TMPDIR'] = args.work_dir
+
+    os.system('mkdir -p $TMPDIR')
+
+    slurm_job_id = process.get_slurm_job_id()
+
+    if args.manifest:
+        sessions = read_manifest(args.manifest)
+    else:
+        sessions = discover_sessions(args.bids_dir)
+    logger.info('found %s sessions to process', len(sessions))
+
+    # a dataset-wide index is only built once and shared by every session
+    dataset_index = None
+    if args.index_scope == 'dataset':
+        dataset_index = Index(args.bids_dir)
+
+    if args.detach:
+        process.check_detach(E)
+
+    # build prequal and qsiprep jobs for every session
+    batch = list()
+    for sub,ses,run in sessions:
+        session = Session(args, sub, ses, run, slurm_job_id)
+        try:
+            session.build(dataset_index)
+        except (Exception, SystemExit) as e:
+            logger.error('failed to build jobs for sub-%s ses-%s: %s', sub, ses, e)
+            continue
+        if not args.detach:
+            session.add_stages(pipeline)
+        batch.append(session)
+
+    if args.dry_run:
+        return
+
+    # submit every session's jobs with their dependent post-processing jobs and exit
+    if args.detach:
+        jobs = list()
+        for session in batch:
+            jobs.extend(process.build_jobs(session.args, session.tasks, session.slurm_job_id, skip=session.skipped))
+        pipelines.submit(E, jobs)
+        logger.info('submitted %s jobs for %s sessions, not waiting for them to finish', len(jobs), len(batch))
+        return
+
+    pipeline.run(limit=args.rate_limit)
+
+    failed = [session for session in batch if not session.ok]
+    logger.info('%s/%s sessions completed', len(batch) - len(failed), len(batch))
+    if failed:
+        for session in failed:
+            logger.error('sub-%s ses-%s failed', session.sub, session.ses)
+            process.log_failed(job for job in session.jobs if job.pid in jarray.failed)
+        sys.exit(1)
+
+class Session:
+    '''
+    The prequal and qsiprep jobs for a single BIDS subject/session
+    '''
+    def __init__(self, args, sub, ses, run, slurm_job_id):
+        self.sub = sub
+        self.ses = ses
+        self.run = run
+        # give each session its own copy of the command line arguments
+        self.args = copy.copy(args)
+        self.args.sub = sub
+        self.args.ses = ses
+        self.args.run = run
+        self.args.artifacts_dir = os.path.join(
+            args.artifacts_dir if args.artifacts_dir else os.path.join(args.bids_dir, 'xnat-artifacts'),
+            f'sub-{sub}',
+            f'ses-{ses}'
+        )
+        # working directories are keyed by job id, keep them unique per subject, session and run
+        self.slurm_job_id = f'{slurm_job_id}_{sub}_{ses}_{run}'
+        self.index = None
+        self.tasks = dict()
+        self.skipped = set()
+        self.stages = list()
+
+    @property
+    def jobs(self):
+        return [task.job for task in self.tasks.values()]
+
+    def build(self, dataset_index=None):
+        if dataset_index:
+            self.index = dataset_index
+        else:
+            self.index = Index(self.args.bids_dir, sub=self.sub, ses=self.ses)
+        process.check_inputs(self.args, self.index.layout)
+        checkpoints = process.get_checkpoints(self.args)
+        if self.args.resume:
+            self.skipped = checkpoints.skip(checkpoint.stages(self.args.sub_tasks))
+        if not self.args.dry_run:
+            process.record(checkpoints, self.args, self.skipped)
+        self.tasks = process.build_tasks(self.args, self.index, self.slurm_job_id, skip=self.skipped)
+
+    def add_stages(self, pipeline):
+        '''
+        Add this session's jobs and post-processing stages to the pipeline.
+        The report runs on the polling thread once every other stage of the
+        session has succeeded.
+        '''
+        self.stages = process.add_stages(pipeline, self.args, self.tasks, self.slurm_job_id, skip=self.skipped)
+        if 'report' in self.skipped:
+            return
+        self.stages.append(pipeline.stage(
+            f'report for sub-{self.sub} ses-{self.ses}',
+            functools.partial(process.report, self.args, self.index),
+            jobs=self.jobs,
+            after=self.stages,
+            inline=True
+        ))
+
+    @property
+    def ok(self):
+        return all(stage.ok for stage in self.stages)
+
+def read_manifest(manifest):
+    '''
+    Read a CSV or YAML manifest of sub, ses and (optionally) run
+    '''
+    with open(manifest) as fo:
+        if manifest.endswith(('.yaml', '.yml')):
+            rows = yaml.safe_load(fo)
+        else:
+            rows = list(csv.DictReader(fo))
+    sessions = list()
+    for row in rows:
+        sub = str(row['sub']).replace('sub-', '')
+        ses = str(row['ses']).replace('ses-', '')
+        run = int(row.get('run') or 1)
+        sessions.append((sub, ses, run))
+    return sessions
+
+def discover_sessions(bids_dir):
+    '''
+    Find every subject/session in the BIDS directory that contains a
+    diffusion scan. The lowest run number is used for each session.
+    '''
+    runs = col.defaultdict(list)
+    pattern = os.path.join(bids_dir, 'sub-*', 'ses-*', 'dwi', '*_dwi.nii*')
+    for filename in sorted(glob.glob(pattern)):
+        dwi_dir = os.path.dirname(filename)
+        ses_dir = os.path.dirname(dwi_dir)
+        sub = os.path.basename(os.path.dirname(ses_dir)).replace('sub-', '')
+        ses = os.path.basename(ses_dir).replace('ses-', '')
+        match = re.search(r'_run-(\d+)_', os.path.basename(filename))
+        runs[(sub, ses)].append(int(match.group(1)) if match else 1)
+    return [(sub, ses, min(r)) for (sub, ses),r in runs.items()]
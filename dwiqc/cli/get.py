@@ -1,20 +1,48 @@
+import io
 import os
 import re
 import sys
 import pdb
 import json
 import yaml
+import hashlib
 import yaxil
 import logging
+import time
+import random
+import zipfile
+import requests
+import tempfile
+import yaxil.bids
 import subprocess as sp
 import collections as col
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
 from xnattagger import Tagger
 from bids import BIDSLayout
 import xnattagger.config as config
+from dwiqc.tags import TagMatcher
+from yaxil.session import Session
+from yaxil.exceptions import YaxilError, DownloadError, RestApiError
+from dwiqc.downloads import Manifest
+from dwiqc.catalogue import Catalogue
 
 
 logger = logging.getLogger(__name__)
 
+# '#DWIQC_T1w' as a standalone tag, without trailing run digits
+DWIQC_T1W = re.compile(r'(?i)#DWIQC_T1w(?!\w)')
+
+# attempts per scan before a download is reported as failed
+DOWNLOAD_ATTEMPTS = 3
+
+# errors raised by a failed download with either engine
+DOWNLOAD_ERRORS = (sp.CalledProcessError, OSError, YaxilError)
+
+# bytes read at a time from a scan download
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
 def do(args):
     if args.insecure:
         logger.warning('disabling ssl certificate verification')
@@ -29,66 +57,141 @@ def do(args):
     logger.info('downloading data from xnat...')
 
 
-    # load authentication data and set environment variables for ArcGet.py
+    # load authentication data, ArcGet.py is given it through its own environment
     auth = yaxil.auth2(
         args.xnat_alias,
         args.xnat_host,
         args.xnat_user,
         args.xnat_pass
     )
-    os.environ['XNAT_HOST'] = auth.url
-    os.environ['XNAT_USER'] = auth.username
-    os.environ['XNAT_PASS'] = auth.password
 
     conf = yaml.safe_load(open(args.download_config)) # load yaml config file
 
     scan_labels = get_scan_types(conf) ### get a list of the scan types/labels
 
-    # query dwi and T1w scans from XNAT
-    scans_to_download = find_scans_to_download(scan_labels, conf, auth, args.label, args.project)
+    # one authenticated session and connection pool is shared by the scan listing and every download
+    with PooledSession(auth, workers=args.download_workers) as sess:
+        scans_meta = list_scans(args, auth, sess)
 
-    scan_labels = get_scan_types(conf)
+        # query dwi and T1w scans from XNAT
+        scans_to_download = find_scans_to_download(scan_labels, conf, auth, args.label, args.project, scans=scans_meta)
 
-    logger.info('downloading the following scans:')
-    logger.info(json.dumps(scans_to_download, indent=2))
+        scan_labels = get_scan_types(conf)
 
-    # download scans
+        logger.info('downloading the following scans:')
+        logger.info(json.dumps(scans_to_download, indent=2))
 
-    for run,scansr in scans_to_download.items():
-        for scan_label in scan_labels:
-            if scan_label in scansr:
-                logger.info('getting run=%s, scan=%s', run, scansr[scan_label])
-                download_scan(args, auth, run, scansr[scan_label], scan_label, conf, verbose=args.verbose)
+        # download scans
+
+        download_scans(args, sess, scans_to_download, scan_labels, conf, scans_meta)
 
-def find_scans_to_download(scan_labels, conf, auth, label, project):
+class PooledSession(Session):
+    '''
+    yaxil session that sends scan downloads over one keep-alive
+    requests.Session. yaxil.bids downloads every scan through the download
+    method of the session it is given, so that is the only call replaced,
+    everything else goes through yaxil as usual.
+    '''
+    def __init__(self, auth, workers=1):
+        super().__init__(auth)
+        self.auth = auth
+        self.workers = workers
+        self.http = None
+        self._accessions = dict()
+
+    def __enter__(self):
+        super().__enter__()
+        self.http = requests.Session()
+        self.http.auth = yaxil.basicauth(self.auth)
+        self.http.cookies.update(self.auth.cookie)
+        self.http.verify = yaxil.CHECK_CERTIFICATE
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+        self.http.mount('http://', adapter)
+        self.http.mount('https://', adapter)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.http.close()
+        return super().__exit__(type, value, traceback)
+
+    def accession(self, label, project=None):
+        '''
+        Accession ID of an experiment, looked up once per session label
+        '''
+        if (label, project) not in self._accessions:
+            self._accessions[(label, project)] = super().accession(label, project=project)
+        return self._accessions[(label, project)]
+
+    def get(self, path, params=None):
+        url = f'{self.url.rstrip("/")}/{path.lstrip("/")}'
+        r = self.http.get(url, params=params)
+        if r.status_code != requests.codes.ok:
+            raise RestApiError(f'response not ok ({r.status_code} {r.reason}) from {r.url}')
+        return r
+
+    def download(self, label, scan_ids=None, project=None, aid=None, out_dir='.', in_mem=True, attempts=1, **kwargs):
+        '''
+        Download and extract scans like yaxil.download, over the pooled
+        connections
+        '''
+        if not aid:
+            aid = self.accession(label, project)
+        scans = ','.join(str(x) for x in scan_ids) if scan_ids else 'ALL'
+        url = f'{self.url.rstrip("/")}/data/experiments/{aid}/scans/{scans}/files'
+        backoff = 10
+        for attempt in range(attempts):
+            r = self.http.get(url, params={'format': 'zip'}, stream=True)
+            if r.status_code == requests.codes.ok:
+                break
+            r.close()
+            if attempt + 1 < attempts:
+                delay = backoff + random.randint(0, 10)
+                logger.warning('download unsuccessful (%s), retrying in %s seconds', r.status_code, delay)
+                time.sleep(delay)
+                backoff *= 2
+        if r.status_code != requests.codes.ok:
+            raise DownloadError(f'response not ok ({r.status_code} {r.reason}) from {r.url}')
+        os.makedirs(out_dir, exist_ok=True)
+        with r, (io.BytesIO() if in_mem else tempfile.TemporaryFile(dir=out_dir, prefix='xnat', suffix='.zip')) as content:
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                content.write(chunk)
+            try:
+                zf = zipfile.ZipFile(content, allowZip64=True)
+            except zipfile.BadZipfile:
+                raise DownloadError(f'bad zip file from {url}')
+            yaxil.extract(zf, content, out_dir)
+
+def find_scans_to_download(scan_labels, conf, auth, label, project, scans=None):
     """
     Iterate through all scans of the given session
     Check for matches in the user provided config file
     If there is more than one T1w image found, do additional
     processing
     """
-    all_usable_scans = get_usable_scans(auth, label, project)
+    all_usable_scans = get_usable_scans(auth, label, project, scans=scans)
     keeper_scans = col.defaultdict(dict)
+
+    verify_dwi_label(conf)
+    matcher = TagMatcher(conf['dwiqc'])
     
-    keeper_scans, remove_dwi_main_label = find_main_diffusion_scans(keeper_scans, all_usable_scans, conf)
+    keeper_scans, remove_dwi_main_label = find_main_diffusion_scans(keeper_scans, all_usable_scans, matcher)
 
     if remove_dwi_main_label:
         scan_labels.remove('dwi_main')
 
-    keeper_scans = populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, conf, num_diffusion_scans=len(keeper_scans))
+    keeper_scans = populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, matcher, num_diffusion_scans=len(keeper_scans))
 
     return keeper_scans
 
 
-def find_main_diffusion_scans(keeper_scans, all_usable_scans, conf):
+def find_main_diffusion_scans(keeper_scans, all_usable_scans, matcher):
     '''
     find all the diffusion scans in the session
     '''
     for scan in all_usable_scans:
-        verify_dwi_label(conf)
-        is_match = match(scan['note'], conf['dwiqc']['dwi_main']['tag'])
-        if is_match:
-            run = is_match.group('run').lstrip('_')
+        tags = matcher.classify(scan['note'])
+        if 'dwi_main' in tags:
+            run = tags['dwi_main'].lstrip('_')
             keeper_scans[run]['dwi_main'] = scan['id']
 
     if not diffusion_exist(keeper_scans):
@@ -107,7 +210,7 @@ def diffusion_exist(keeper_scans):
     return False
 
 
-def populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, conf, num_diffusion_scans):
+def populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, matcher, num_diffusion_scans):
     '''
     Populate the keeper_scans data structure by finding t1w images first and checking their 
     note field.
@@ -117,15 +220,15 @@ def populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, conf, num
 
     # populate t1w scans first
     for scan in all_usable_scans:
-        is_match = match(scan['note'], conf['dwiqc']['t1w']['tag'])
-        if is_match:
+        tags = matcher.classify(scan['note'])
+        if 't1w' in tags:
             if contains_just_dwiqc_t1w(scan['note']):
                 for run in keeper_scans:
                     keeper_scans[run]['t1w'] = scan['ID']
                 scan_labels.remove('t1w')
                 break
             else:
-                run = is_match.group('run').lstrip('_')
+                run = tags['t1w'].lstrip('_')
                 if run not in keeper_scans:
                     logger.error('More than one t1w image found. Please specify desired t1 image with tag: #DWIQC_T1w (note the lack of trailing integers).\nSee documentation for further details: <docs_link>')
                     sys.exit()
@@ -133,10 +236,10 @@ def populate_keeper_scans(keeper_scans, all_usable_scans, scan_labels, conf, num
 
     # populate fmap scans
     for scan in all_usable_scans:
+        tags = matcher.classify(scan['note'])
         for scan_label in scan_labels:
-            is_match = match(scan['note'], conf['dwiqc'][scan_label]['tag'])
-            if is_match:
-                run = is_match.group('run').lstrip('_')
+            if scan_label in tags:
+                run = tags[scan_label].lstrip('_')
                 keeper_scans[run][scan_label] = scan['id']
 
     return keeper_scans
@@ -147,8 +250,7 @@ def contains_just_dwiqc_t1w(scan_note):
     Returns False if followed by additional characters (e.g. '_001').
     Case insensitive.
     '''
-    pattern = r'(?i)#DWIQC_T1w(?!\w)'
-    return bool(re.search(pattern, scan_note))
+    return bool(DWIQC_T1W.search(scan_note))
 
 def verify_dwi_label(conf):
     try:
@@ -157,15 +259,40 @@ def verify_dwi_label(conf):
         logger.error('please specify a "dwi_main" label in your download-config.yaml file')
         sys.exit()
 
-def get_usable_scans(auth, label, project):
-    with yaxil.session(auth) as ses:
-            all_scans = []
-            for scan in ses.scans(label=label, project=project):
-                if scan['quality'] == 'unusable':
-                    logger.warning(f"scan {scan['ID']} is unusable and will not be downloaded")
-                    continue
-                else:
-                    all_scans.append(scan)
+def list_scans(args, auth, sess):
+    '''
+    List the scans of the session, from the project scan catalogue when
+    --catalogue-dir is given
+    '''
+    if args.catalogue_dir:
+        if not args.project:
+            logger.warning('the scan catalogue requires --project, listing session scans instead')
+        elif args.run_tagger:
+            # xnattagger just rewrote this session's notes, the catalogue may predate that
+            logger.info('xnattagger updated scan notes, listing session scans instead of using the catalogue')
+        else:
+            catalogue = Catalogue(auth, args.project, args.catalogue_dir, expiry=args.catalogue_expiry * 60)
+            scans = catalogue.scans(args.label)
+            if scans:
+                return scans
+            logger.warning('session %s is not in the scan catalogue for project %s', args.label, args.project)
+    return list(sess.scans(label=args.label, project=args.project))
+
+def get_usable_scans(auth, label, project, scans=None):
+    '''
+    Filter out unusable scans, listing the session's scans first unless
+    they were already fetched
+    '''
+    if scans is None:
+        with yaxil.session(auth) as ses:
+            scans = list(ses.scans(label=label, project=project))
+    all_scans = []
+    for scan in scans:
+        if scan['quality'] == 'unusable':
+            logger.warning(f"scan {scan['ID']} is unusable and will not be downloaded")
+            continue
+        else:
+            all_scans.append(scan)
     return all_scans
 
 def run_xnattagger(args):
@@ -195,10 +322,143 @@ def get_scan_types(conf):
 
     return scan_types
 
-def download_scan(args, auth, run, scan, config_label, input_config, verbose=False):
+def download_scans(args, sess, scans_to_download, scan_labels, conf, scans_meta):
+    '''
+    Download every selected scan in one request. If that fails, fall back
+    to downloading scans individually on a bounded pool of workers,
+    retrying each one and reporting every failure at once.
+    '''
+    downloads = list()
+    for run,scansr in scans_to_download.items():
+        for scan_label in scan_labels:
+            if scan_label in scansr:
+                downloads.append((run, scansr[scan_label], scan_label))
+
+    # every download is recorded, --resume fingerprints fieldmaps by it
+    manifest = Manifest(session_dir(args.bids_dir, scans_meta))
+    remote = remote_stamps(sess, scans_meta, [scan for _,scan,_ in downloads])
+    if args.incremental:
+        downloads = manifest.pending(downloads, remote)
+        if not downloads:
+            logger.info('all scans are already downloaded')
+            return
+
+    try:
+        download_session(args, sess, downloads, conf, scans_meta, verbose=args.verbose)
+        record_downloads(args, manifest, downloads, conf, remote)
+        return
+    except DOWNLOAD_ERRORS as e:
+        logger.warning('downloading all scans at once failed (%s), downloading scans individually', e)
+
+    errors = list()
+    finished = list()
+    with ThreadPoolExecutor(max_workers=args.download_workers) as pool:
+        futures = dict()
+        for run,scan,scan_label in downloads:
+            logger.info('getting run=%s, scan=%s', run, scan)
+            future = pool.submit(download_scan_with_retry, args, sess, run, scan, scan_label, conf, scans_meta, verbose=args.verbose)
+            futures[future] = (run, scan, scan_label)
+        for future in as_completed(futures):
+            run,scan,scan_label = futures[future]
+            try:
+                future.result()
+                logger.info('finished run=%s, scan=%s', run, scan)
+                finished.append((run, scan, scan_label))
+            except DOWNLOAD_ERRORS as e:
+                errors.append((run, scan, scan_label, e))
+
+    # record the scans that made it so a re-run only fetches the failures
+    record_downloads(args, manifest, finished, conf, remote)
+
+    if errors:
+        for run,scan,scan_label,e in errors:
+            logger.error('failed to download %s run=%s, scan=%s after %s attempts: %s', scan_label, run, scan, DOWNLOAD_ATTEMPTS, e)
+        logger.error('%s/%s scans failed to download', len(errors), len(downloads))
+        sys.exit(1)
+
+def session_dir(bids_dir, scans_meta):
+    '''
+    BIDS session directory that scans from this XNAT session are saved to
+    '''
+    scan = scans_meta[0]
+    return os.path.join(
+        bids_dir,
+        'sub-' + yaxil.bids.legal.sub('', scan['subject_label']),
+        'ses-' + yaxil.bids.legal.sub('', scan['session_label'])
+    )
+
+def remote_stamps(sess, scans_meta, scans):
+    '''
+    Stamp of the DICOM files of each scan on XNAT, a checksum of their
+    names, sizes and digests, so a scan that was changed on XNAT is
+    downloaded again
+    '''
+    aid = scans_meta[0]['session_id']
+    stamps = dict()
+    for scan in scans:
+        r = sess.get(f'/data/experiments/{aid}/scans/{scan}/files', params={'format': 'json'})
+        rows = [row for row in r.json()['ResultSet']['Result'] if row.get('collection') == 'DICOM']
+        sha = hashlib.sha1()
+        for row in sorted(rows, key=lambda row: row['Name']):
+            sha.update(f'{row["Name"]}:{row.get("Size")}:{row.get("digest")}\n'.encode('utf-8'))
+        stamps[str(scan)] = sha.hexdigest()
+    return stamps
+
+def record_downloads(args, manifest, downloads, input_config, remote):
+    '''
+    Save the scan ID, remote stamp and files of downloaded scans to the
+    download manifest
+    '''
+    if args.dry_run:
+        return
+    for run,scan,scan_label in downloads:
+        bids_subdir,_,_ = scan_config(run, scan, scan_label, input_config)
+        manifest.record(run, scan, scan_label, bids_subdir, remote.get(str(scan)))
+    manifest.save()
+
+def download_session(args, sess, downloads, input_config, scans_meta, verbose=False):
+    '''
+    Merge the BIDS config of every (run, scan, scan_label) into one config
+    and download them all at once
+    '''
+    config = col.defaultdict(lambda: col.defaultdict(list))
+    for run,scan,scan_label in downloads:
+        logger.info('getting run=%s, scan=%s', run, scan)
+        bids_subdir,bids_suffix,entry = scan_config(run, scan, scan_label, input_config)
+        config[bids_subdir][bids_suffix].append(entry)
+    config = {subdir: dict(suffixes) for subdir,suffixes in config.items()}
+    fetch(args, sess, config, scans_meta, verbose=verbose)
+
+@retry(
+    retry=retry_if_exception_type(DOWNLOAD_ERRORS),
+    stop=stop_after_attempt(DOWNLOAD_ATTEMPTS),
+    wait=wait_exponential(multiplier=5, max=60),
+    reraise=True
+)
+def download_scan_with_retry(args, sess, run, scan, config_label, input_config, scans_meta, verbose=False):
+    download_scan(args, sess, run, scan, config_label, input_config, scans_meta, verbose=verbose)
+
+def download_scan(args, sess, run, scan, config_label, input_config, scans_meta, verbose=False):
     '''
     Function that downloads an individual scan based on information from the config input file and command line arguments.
     '''
+    bids_subdir,bids_suffix,entry = scan_config(run, scan, config_label, input_config)
+
+    # create config file for ArcGet.py
+
+    config = {
+        bids_subdir: {
+            bids_suffix: [entry]
+        }
+    }
+
+    fetch(args, sess, config, scans_meta, verbose=verbose)
+
+def scan_config(run, scan, config_label, input_config):
+    '''
+    Build the ArcGet config entry for a single scan. Returns the BIDS
+    sub-directory, the BIDS suffix and the entry itself.
+    '''
 
     # check for bids sub-directory specification in config file
     try:
@@ -231,30 +491,43 @@ def download_scan(args, auth, run, scan, config_label, input_config, verbose=Fal
 
     bids_suffix = suffix_mapping.get(bids_subdir, None)
 
-    # create config file for ArcGet.py
-
-    config = {
-        bids_subdir: {
-            bids_suffix: [
-                {
-                    'run': int(run),
-                    'scan': scan,
-                }
-            ]
-        }
+    entry = {
+        'run': int(run),
+        'scan': scan,
     }
 
     # if phase encode direction and acquisition group are supplied, add them to config file
 
     if direction:
-        config[bids_subdir][bids_suffix][0]['direction'] = direction
+        entry['direction'] = direction
 
     if acq:
-        config[bids_subdir][bids_suffix][0]['acquisition'] = acq
+        entry['acquisition'] = acq
+
+    return bids_subdir, bids_suffix, entry
+
+def fetch(args, sess, config, scans_meta, verbose=False):
+    '''
+    Download the scans in a BIDS config with the selected download engine.
+    The yaxil engine runs in this process on the already authenticated
+    session, the arcget engine runs ArcGet.py in a subprocess.
+    '''
+    if args.download_engine == 'arcget':
+        arcget(args, sess.auth, config, verbose=verbose)
+        return
+    logger.info('downloading %s', json.dumps(config))
+    if not args.dry_run:
+        yaxil.bids.bids_from_config(sess, scans_meta, config, args.bids_dir, args.in_mem)
 
+def arcget(args, auth, config, verbose=False):
+    '''
+    Run ArcGet.py with the given BIDS config. The XNAT credentials are only
+    set in the environment of the subprocess, so concurrent downloads of
+    sessions from different servers do not share them.
+    '''
     config = yaml.safe_dump(config)
 
-    # create ArcGet.py command to download scan
+    # create ArcGet.py command to download scans
     cmd = [
         'ArcGet.py',
         '--label', args.label,
@@ -280,16 +553,5 @@ def download_scan(args, auth, run, scan, config_label, input_config, verbose=Fal
         cmd.append('--debug')
     logger.info(sp.list2cmdline(cmd))
     if not args.dry_run:
-        sp.check_output(cmd, input=config.encode('utf-8'))
-
-def match(note, patterns):
-    '''
-    This function uses regular expression matching to match the tags in the scan note field to the config file
-    '''
-
-    for pattern in patterns:
-        m = re.match(pattern, note, flags=re.IGNORECASE)
-        if m:
-            return m
-    return None
-
+        env = dict(os.environ, XNAT_HOST=auth.url, XNAT_USER=auth.username, XNAT_PASS=auth.password)
+        sp.check_output(cmd, input=config.encode('utf-8'), env=env)
@@ -0,0 +1,34 @@
+import os
+import yaxil
+import logging
+from dwiqc.layout import Index
+import dwiqc.cli.process as process
+
+
+logger = logging.getLogger(__name__)
+
+def do(args):
+    '''
+    Run a single post-processing stage. This is what the jobs submitted by
+    process --detach execute once their parent jobs have succeeded.
+    '''
+    if args.insecure:
+        logger.warning('disabling ssl certificate verification')
+        yaxil.CHECK_CERTIFICATE = False
+
+    if args.work_dir:
+        os.environ['TMPDIR'] = args.work_dir
+        os.makedirs(args.work_dir, exist_ok=True)
+
+    logger.info('running %s post-processing for sub-%s ses-%s', args.stage, args.sub, args.ses)
+
+    if args.stage == 'prequal':
+        process.prequal_postprocess(args, args.slurm_job_id)
+    elif args.stage == 'qsiprep':
+        process.qsiprep_postprocess(args, args.slurm_job_id)
+    elif args.stage == 'report':
+        if args.index_scope == 'session':
+            index = Index(args.bids_dir, sub=args.sub, ses=args.ses)
+        else:
+            index = Index(args.bids_dir)
+        process.report(args, index)
@@ -9,12 +9,23 @@ import math
 import logging
 import tarfile
 import executors
+import executors.slurm
+import executors.pbsubmit
 import tempfile
+import functools
 import subprocess as sp
 import shutil
 from executors.models import Job, JobArray
-from bids import BIDSLayout
 from dwiqc.xnat import Report
+from dwiqc.upload import Uploader
+from dwiqc.layout import Index
+import dwiqc.checkpoint as checkpoint
+from dwiqc.cache import ResultCache
+import dwiqc.cache as cache
+from dwiqc.state import State
+from dwiqc.tasks import BaseTask
+import dwiqc.pipeline as pipelines
+from dwiqc.pipeline import Pipeline, Parents
 import dwiqc.tasks.prequal as prequal
 import dwiqc.tasks.qsiprep as qsiprep
 import dwiqc.tasks.prequal_EQ as prequal_EQ
@@ -30,35 +41,99 @@ def do(args):
         logger.warning('disabling ssl certificate verification')
         yaxil.CHECK_CERTIFICATE = False
 
+    # create job executor, job array and post-processing pipeline
+    E = get_executor(args)
+    jarray = JobArray(E)
+    pipeline = Pipeline(jarray)
+
+    if args.work_dir:
+        os.environ['TMPDIR'] = args.work_dir
+
+    slurm_job_id = get_slurm_job_id()
+
+    # load data into pybids as layout, shared by every task and the report
+
+    if args.index_scope == 'session':
+        index = Index(args.bids_dir, sub=args.sub, ses=args.ses)
+    else:
+        index = Index(args.bids_dir)
+
+    # verify the existence of diffusion data and/or fieldmaps
+
+    check_inputs(args, index.layout)
+
+    os.system('mkdir -p $TMPDIR')
+
+    # create artifacts directory
+
+    if not args.artifacts_dir:
+        args.artifacts_dir = os.path.join(
+            args.bids_dir,
+            'xnat-artifacts'
+        )
+
+    # skip stages that already completed with the same inputs and configuration
+    checkpoints = get_checkpoints(args)
+    skipped = set()
+    if args.resume:
+        skipped = checkpoints.skip(checkpoint.stages(args.sub_tasks))
+
+    # build prequal and qsiprep jobs, restoring unchanged outputs from the cache
+    if not args.dry_run:
+        record(checkpoints, args, skipped)
+    tasks = build_tasks(args, index, slurm_job_id, skip=skipped)
+
+    # submit every job along with dependent post-processing jobs and exit
+    if args.detach:
+        check_detach(E)
+        jobs = build_jobs(args, tasks, slurm_job_id, skip=skipped)
+        if not args.dry_run:
+            pipelines.submit(E, jobs)
+            logger.info('submitted %s jobs, not waiting for them to finish', len(jobs))
+        return
+
+    # otherwise add their post-processing stages to the pipeline
+    add_stages(pipeline, args, tasks, slurm_job_id, skip=skipped)
+
+    # submit jobs and post-process each one as soon as it finishes
+    if not args.dry_run:
+        logger.info('submitting jobs')
+        pipeline.run(limit=args.rate_limit)
+        numjobs = len(jarray.array)
+        failed = len(jarray.failed)
+        complete = len(jarray.complete)
+        if failed:
+            logger.info('%s/%s jobs failed', failed, numjobs)
+            log_failed(jarray.failed.values())
+        logger.info('%s/%s jobs completed', complete, numjobs)
+        if failed > 0 or pipeline.failed:
+            sys.exit(1)
+
+    if 'report' in skipped:
+        return
+
+    report(args, index)
+
+def get_executor(args):
     if args.exclude_nodes:
         excluded_nodes = list(args.exclude_nodes)
     else:
         excluded_nodes = ['']
 
-    # create job executor and job array
     if args.scheduler:
-        E = executors.get(args.scheduler, partition=args.partition)
-    else:
-        E = executors.probe(args.partition, exclude=excluded_nodes)
-    jarray = JobArray(E)
-
-    if args.work_dir:
-        os.environ['TMPDIR'] = args.work_dir
+        return executors.get(args.scheduler, partition=args.partition)
+    return executors.probe(args.partition, exclude=excluded_nodes)
 
+def get_slurm_job_id():
     try: 
         slurm_job_id = f"SLURM_JOB_{os.environ['SLURM_JOB_ID']}"
     except KeyError:
         logger.warning('could not find slurm job id, populating value with random number')
         random_int = get_random_int(7)
         slurm_job_id = f"SLURM_JOB_{random_int}"
+    return slurm_job_id
 
-
-    # load data into pybids as layout
-
-    layout = BIDSLayout(args.bids_dir)
-
-    # verify the existence of diffusion data and/or fieldmaps
-
+def check_inputs(args, layout):
     try:
         dwi_file = os.path.basename(layout.get(subject=args.sub, extension='.nii.gz', suffix='dwi', run=args.run, return_type='filename').pop())
     except IndexError:
@@ -79,39 +154,77 @@ def do(args):
 
     json_file = os.path.basename(layout.get(subject=args.sub, extension='.json', suffix='dwi', run=args.run, return_type='filename').pop())
 
-    basename = os.path.splitext(json_file)[0]
-
-    os.system('mkdir -p $TMPDIR')
+def prequal_outdir(args):
+    return os.path.join(args.bids_dir, 'derivatives', 'dwiqc-prequal', f'sub-{args.sub}', f'ses-{args.ses}', 'OUTPUTS')
+
+def qsiprep_outdir(args):
+    return os.path.join(args.bids_dir, 'derivatives', 'dwiqc-qsiprep', f'sub-{args.sub}', f'ses-{args.ses}', 'qsiprep_output')
+
+def get_checkpoints(args):
+    return checkpoint.Checkpoints(args, {
+        'prequal': prequal_outdir(args),
+        'qsiprep': qsiprep_outdir(args)
+    })
+
+def record(checkpoints, args, skipped):
+    '''
+    Save the fingerprint of every stage that is about to run with --resume.
+    Without it fingerprints are not computed, and saved ones are discarded
+    since the stages run again.
+    '''
+    for stage in checkpoint.stages(args.sub_tasks):
+        if stage in skipped:
+            continue
+        if args.resume:
+            checkpoints.record(stage)
+        else:
+            checkpoints.discard(stage)
+
+def get_cache(args):
+    if args.cache_dir:
+        return ResultCache(args.cache_dir)
+    return None
+
+def build_tasks(args, index, slurm_job_id, skip=()):
+    '''
+    Build the prequal and qsiprep tasks requested with --sub-tasks, leaving
+    out any that are in skip or whose outputs were restored from the cache
+    '''
+    tasks = dict()
+    result_cache = get_cache(args)
 
     # prequal job
-    prequal_outdir = None
-    if 'prequal' in args.sub_tasks:
+    if 'prequal' in args.sub_tasks and 'prequal' not in skip:
         logger.debug('building prequal task')
-        prequal_outdir = os.path.join(args.bids_dir, 'derivatives', 'dwiqc-prequal', f'sub-{args.sub}', f'ses-{args.ses}', 'OUTPUTS')
         prequal_task = prequal.Task(
             sub=args.sub,
             ses=args.ses,
             run=args.run,
             bids=args.bids_dir,
-            outdir=prequal_outdir,
+            outdir=prequal_outdir(args),
             fs_license = args.fs_license,
+            index=index,
+            cache=result_cache,
             slurm_job_id=slurm_job_id,
             container_dir = args.container_dir,
             prequal_config=args.prequal_config,
             custom_eddy_stdev=args.custom_eddy_prequal_stdev,
             no_gpu=args.no_gpu,
+            inputs_staging=args.inputs_staging,
+            scratch=args.scratch_dir,
             tempdir=tempfile.gettempdir(),
             pipenv='/sw/apps/prequal'
         )
         os.environ['OPENBLAS_NUM_THREADS'] = '1'
         logger.info(f'SINGULARITY_BIND: {os.environ["SINGULARITY_BIND"]}')
         logger.info(json.dumps(prequal_task.command, indent=1))
-        jarray.add(prequal_task.job)
+        if prequal_task.cached:
+            logger.info('prequal outputs restored from cache, not submitting prequal')
+        else:
+            tasks['prequal'] = prequal_task
 
     # qsiprep job
-    qsiprep_outdir = None
-    if 'qsiprep' in args.sub_tasks:
-        qsiprep_outdir = os.path.join(args.bids_dir, 'derivatives', 'dwiqc-qsiprep', f'sub-{args.sub}', f'ses-{args.ses}', 'qsiprep_output')
+    if 'qsiprep' in args.sub_tasks and 'qsiprep' not in skip:
         qsiprep_trick = tempfile.TemporaryDirectory(dir='/tmp', suffix='.qsiprep')
         #os.symlink(qsiprep_outdir, f"{qsiprep_trick}/q")
         qsiprep_task = qsiprep.Task(
@@ -119,67 +232,197 @@ def do(args):
             ses=args.ses,
             run=args.run,
             bids=args.bids_dir,
-            outdir=qsiprep_outdir,
+            outdir=qsiprep_outdir(args),
             qsiprep_config=args.qsiprep_config,
             fs_license=args.fs_license,
             slurm_job_id=slurm_job_id,
             truncate_fmap=args.truncate_qsiprep_fmap,
+            index=index,
+            cache=result_cache,
             container_dir = args.container_dir,
             custom_eddy_qsiprep=args.custom_eddy_qsiprep,
             no_gpu=args.no_gpu,
+            scratch=args.scratch_dir,
             tempdir=tempfile.gettempdir(),
             pipenv='/sw/apps/qsiprep'
         )
         os.environ['OPENBLAS_NUM_THREADS'] = '1'
         logger.info(json.dumps(qsiprep_task.command, indent=1))
         #check_for_output(args, qsiprep_outdir)
-        jarray.add(qsiprep_task.job)
-
-    # submit jobs and wait for them to finish
-    if not args.dry_run:
-        logger.info('submitting jobs')
-        jarray.submit(limit=args.rate_limit)
-        logger.info('waiting for all jobs to finish')
-        jarray.wait()
-        numjobs = len(jarray.array)
-        failed = len(jarray.failed)
-        complete = len(jarray.complete)
-        if 'prequal' in args.sub_tasks:
-            prequal_eddy(args, prequal_outdir, slurm_job_id)
-        if 'qsiprep' in args.sub_tasks:
-            qsiprep_eddy(args, qsiprep_outdir, slurm_job_id)
-            browser.snapshot(f"{qsiprep_outdir}/qsiprep/sub-{args.sub}.html", f"{qsiprep_outdir}/qsiprep/qsiprep.pdf", args.container_dir)
-            browser.imbed_images(f"{qsiprep_outdir}/qsiprep/sub-{args.sub}.html")
-        if failed:
-            logger.info('%s/%s jobs failed', failed, numjobs)
-            for pid,job in iter(jarray.failed.items()):
-                logger.error('%s exited with returncode %s', job.name, job.returncode)
-                with open(job.output, 'r') as fp:
-                    logger.error('standard output\n%s', fp.read())
-                with open(job.error, 'r') as fp:
-                    logger.error('standard error\n%s', fp.read())
-        logger.info('%s/%s jobs completed', complete, numjobs)
-        if failed > 0:
-            sys.exit(1)
-
-    # create artifacts directory
-
-    if not args.artifacts_dir:
-        args.artifacts_dir = os.path.join(
-            args.bids_dir,
-            'xnat-artifacts'
-        )
-
-    # build data to upload to xnat
-    R = Report(args.bids_dir, args.sub, args.ses, args.run)
-    logger.info('building xnat artifacts to %s', args.artifacts_dir)
-    R.build_assessment(args.artifacts_dir)
-
-    # upload data to xnat over rest api
+        if qsiprep_task.cached:
+            logger.info('qsiprep outputs restored from cache, not submitting qsiprep')
+        else:
+            tasks['qsiprep'] = qsiprep_task
+
+    return tasks
+
+def add_stages(pipeline, args, tasks, slurm_job_id, skip=()):
+    '''
+    Add each task's job to the pipeline along with the stages that run on
+    its output as soon as that job completes. Returns the list of stages.
+    '''
+    stages = list()
+    for name,func in (('prequal', prequal_postprocess), ('qsiprep', qsiprep_postprocess)):
+        jobs = list()
+        if name in tasks:
+            jobs.append(tasks[name].job)
+            pipeline.add(tasks[name].job)
+        if name not in args.sub_tasks or f'{name}-postprocess' in skip:
+            continue
+        stages.append(pipeline.stage(
+            f'{name} post-processing for sub-{args.sub} ses-{args.ses}',
+            functools.partial(func, args, slurm_job_id),
+            jobs=jobs
+        ))
+    return stages
+
+def check_detach(E):
+    '''
+    Only schedulers that can hold a job until several others have succeeded
+    are able to run the post-processing jobs without the driver
+    '''
+    if not isinstance(E, (executors.slurm.Executor, executors.pbsubmit.Executor)):
+        logger.error('--detach requires a slurm or pbsubmit job scheduler. Exiting.')
+        sys.exit(1)
+
+def build_jobs(args, tasks, slurm_job_id, skip=()):
+    '''
+    Build the prequal and qsiprep jobs followed by eddy_quad and report jobs
+    that wait for their parents to succeed. Returns the jobs in the order
+    they need to be submitted.
+    '''
+    jobs = list()
+    eq_jobs = list()
+    for name,outdir in (('prequal', prequal_outdir(args)), ('qsiprep', qsiprep_outdir(args))):
+        parent = None
+        if name in tasks:
+            parent = tasks[name].job
+            jobs.append(parent)
+        if name in args.sub_tasks and f'{name}-postprocess' not in skip:
+            eq_jobs.append(postprocess_job(args, name, outdir, parent, slurm_job_id))
+    jobs.extend(eq_jobs)
+    # the report needs the output of both pipelines
+    if 'prequal' not in args.sub_tasks or 'qsiprep' not in args.sub_tasks:
+        logger.info('report requires both prequal and qsiprep, not submitting a report job')
+    elif 'report' not in skip:
+        parent = Parents(eq_jobs) if eq_jobs else None
+        jobs.append(postprocess_job(args, 'report', qsiprep_outdir(args), parent, slurm_job_id))
+    return jobs
+
+def postprocess_job(args, stage, outdir, parent, slurm_job_id):
+    logdir = os.path.join(outdir, 'logs')
+    os.makedirs(logdir, exist_ok=True)
+    logfile = os.path.join(logdir, f'dwiqc-{stage}-postprocess.log')
+    return Job(
+        name=f'dwiqc-{stage}-postprocess',
+        time='120',
+        memory='8G',
+        command=postprocess_command(args, stage, slurm_job_id),
+        output=logfile,
+        error=logfile,
+        parent=parent
+    )
+
+def postprocess_command(args, stage, slurm_job_id):
+    '''
+    Command line that runs a post-processing stage through this same
+    dwiQC.py script and interpreter
+    '''
+    command = [sys.executable, os.path.realpath(sys.argv[0])]
+    if args.insecure:
+        command.append('--insecure')
+    command.extend([
+        'postprocess',
+        '--stage', stage,
+        '--sub', args.sub,
+        '--ses', args.ses,
+        '--run', str(args.run),
+        '--bids-dir', os.path.abspath(args.bids_dir),
+        '--slurm-job-id', slurm_job_id,
+        '--index-scope', args.index_scope,
+        '--artifacts-dir', os.path.abspath(args.artifacts_dir),
+        '--sub-tasks'
+    ])
+    command.extend(args.sub_tasks)
+    if args.container_dir:
+        command.extend(['--container-dir', args.container_dir])
+    if args.work_dir:
+        command.extend(['--work-dir', args.work_dir])
     if args.xnat_upload:
-        logger.info('Uploading artifacts to XNAT')
-        auth = yaxil.auth2(args.xnat_alias)
-        yaxil.storerest(auth, args.artifacts_dir, 'dwiqc-resource')
+        command.append('--xnat-upload')
+    if args.xnat_alias:
+        command.extend(['--xnat-alias', args.xnat_alias])
+    if args.upload_bundle:
+        command.extend(['--upload-bundle', args.upload_bundle])
+    command.extend(['--artifacts-staging', args.artifacts_staging])
+    # the qsiprep work directory is named with the date the job was submitted
+    command.extend(['--qsiprep-date', qsiprep.date])
+    if args.cache_dir:
+        command.extend(['--cache-dir', args.cache_dir])
+    return command
+
+def prequal_postprocess(args, slurm_job_id):
+    with checkpoint.provenance(get_checkpoints(args).provenance('prequal-postprocess')):
+        store_outputs(args, prequal_outdir(args))
+        prequal_eddy(args, prequal_outdir(args), slurm_job_id)
+
+def qsiprep_postprocess(args, slurm_job_id):
+    outdir = qsiprep_outdir(args)
+    with checkpoint.provenance(get_checkpoints(args).provenance('qsiprep-postprocess')):
+        # eddy_quad needs the qsiprep work directory, which is not cached, so the
+        # entry includes the eddy_quad results and they are not recomputed on a hit
+        metrics = os.path.join(outdir, 'qsiprep', 'EDDY', 'eddy_metrics.json')
+        if restored(outdir) and os.path.exists(metrics):
+            logger.info('eddy_quad results restored from result cache, not running eddy_quad')
+        else:
+            qsiprep_eddy(args, outdir, slurm_job_id)
+            store_outputs(args, outdir)
+        browser.snapshot(f"{outdir}/qsiprep/sub-{args.sub}.html", f"{outdir}/qsiprep/qsiprep.pdf", args.container_dir)
+        browser.imbed_images(f"{outdir}/qsiprep/sub-{args.sub}.html")
+
+def store_outputs(args, outdir):
+    '''
+    Add the outputs of a successful prequal or qsiprep job to the result
+    cache
+    '''
+    result_cache = get_cache(args)
+    if not result_cache:
+        return
+    key = cache.tracked(outdir)
+    prov = os.path.join(outdir, 'logs', 'provenance.json')
+    if key and BaseTask.state(prov) == State.COMPLETE:
+        result_cache.store(key, outdir)
+
+def restored(outdir):
+    '''
+    Whether the outputs in outdir were restored from the result cache
+    '''
+    prov = os.path.join(outdir, 'logs', 'provenance.json')
+    if not os.path.exists(prov):
+        return False
+    with open(prov) as fo:
+        return 'cache' in json.load(fo)
+
+def log_failed(jobs):
+    for job in jobs:
+        logger.error('%s exited with returncode %s', job.name, job.returncode)
+        with open(job.output, 'r') as fp:
+            logger.error('standard output\n%s', fp.read())
+        with open(job.error, 'r') as fp:
+            logger.error('standard error\n%s', fp.read())
+
+def report(args, index):
+    with checkpoint.provenance(get_checkpoints(args).provenance('report')):
+        # build data to upload to xnat
+        R = Report(args.bids_dir, args.sub, args.ses, args.run, index=index)
+        logger.info('building xnat artifacts to %s', args.artifacts_dir)
+        R.build_assessment(args.artifacts_dir, staging=args.artifacts_staging)
+
+        # upload data to xnat over rest api
+        if args.xnat_upload:
+            logger.info('Uploading artifacts to XNAT')
+            auth = yaxil.auth2(args.xnat_alias)
+            Uploader(auth, args.artifacts_dir, 'dwiqc-resource', bundle=args.upload_bundle).upload()
 
 def get_random_int(num_ints):
     range_start = 10**(num_ints-1)
@@ -212,6 +455,8 @@ def qsiprep_eddy(args, qsiprep_outdir, slurm_job_id):
             outdir=qsiprep_outdir,
             container_dir = args.container_dir,
             slurm_job_id=slurm_job_id,
+            work_date=getattr(args, 'qsiprep_date', None) or qsiprep.date,
+            spec_file=qsiprep.slspec(qsiprep_outdir),
             tempdir=tempfile.gettempdir(),
         )
 
@@ -0,0 +1,142 @@
+import os
+import sys
+import copy
+import yaml
+import yaxil
+import logging
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dwiqc.tags import TagMatcher
+from dwiqc.catalogue import Catalogue
+import dwiqc.cli.tandem as tandem
+import dwiqc.cli.process as process
+
+logger = logging.getLogger(__name__)
+
+# xsi type of the assessors built by Report.build_assessment
+ASSESSOR_TYPE = 'neuroinfo:dwiqc'
+
+# default location of the project scan catalogue
+CATALOGUE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dwiqc', 'catalogue')
+
+def do(args):
+    if args.insecure:
+        logger.warning('disabling ssl certificate verification')
+        yaxil.CHECK_CERTIFICATE = False
+
+    auth = yaxil.auth2(
+        args.xnat_alias,
+        args.xnat_host,
+        args.xnat_user,
+        args.xnat_pass
+    )
+
+    conf = yaml.safe_load(open(args.download_config))
+
+    # every session downloads from the catalogue fetched here
+    if not args.catalogue_dir:
+        args.catalogue_dir = CATALOGUE_DIR
+
+    with yaxil.session(auth):
+        catalogue = Catalogue(auth, args.project, args.catalogue_dir, expiry=args.catalogue_expiry * 60)
+        sessions = catalogue.refresh()
+        processed = assessors(auth, args.project)
+    logger.info('found %s DWIQC assessors in project %s', len(processed), args.project)
+
+    pending = find_pending(sessions, processed, conf)
+    logger.info('%s of %s sessions need processing', len(pending), len(sessions))
+    if args.limit:
+        pending = pending[:args.limit]
+    for label in pending:
+        logger.info('queueing session %s', label)
+    if args.dry_run:
+        return
+
+    failed = run(args, pending)
+    if failed:
+        logger.error('%s/%s sessions failed: %s', len(failed), len(pending), ', '.join(sorted(failed)))
+        sys.exit(1)
+
+def assessors(auth, project):
+    '''
+    IDs and labels of every DWIQC assessor in the project
+    '''
+    params = {
+        'project': project,
+        'xsiType': ASSESSOR_TYPE,
+        'columns': 'ID,label'
+    }
+    r = yaxil.get(auth, '/data/experiments', autobox=True, fmt='json', params=params)
+    found = set()
+    for row in r.content['ResultSet']['Result']:
+        found.update([row.get('ID'), row.get('label')])
+    return found
+
+def find_pending(sessions, processed, conf):
+    '''
+    Sessions with a usable main diffusion scan that none of the existing
+    {experiment}_DWI_{scan}_DWIQC assessors was built from
+    '''
+    matcher = TagMatcher(conf['dwiqc'])
+    pending = list()
+    for label,scans in sorted(sessions.items()):
+        dwi = [scan['id'] for scan in scans if scan['quality'] != 'unusable' and 'dwi_main' in matcher.classify(scan['note'])]
+        if not dwi:
+            logger.debug('session %s has no tagged diffusion scans', label)
+            continue
+        if any(f'{label}_DWI_{scan}_DWIQC' in processed for scan in dwi):
+            logger.debug('session %s already has a DWIQC assessor', label)
+            continue
+        pending.append(label)
+    return pending
+
+def run(args, pending):
+    '''
+    Download sessions on one bounded pool and process them on another as
+    soon as their download finishes. Returns the sessions that failed.
+
+    Downloads run on threads and are given their XNAT credentials
+    explicitly. Processing sets process-wide state such as environment
+    variables, so sessions are processed in worker processes rather than
+    threads. Workers are spawned rather than forked from this threaded
+    process and log through the same handlers.
+    '''
+    failed = list()
+    root = logging.getLogger()
+    with ThreadPoolExecutor(max_workers=args.max_downloads) as downloads, \
+         ProcessPoolExecutor(max_workers=args.max_sessions, mp_context=mp.get_context('spawn'),
+                             initializer=configure_worker,
+                             initargs=(root.level, [h.formatter for h in root.handlers])) as processing:
+        running = dict()
+        for label in pending:
+            session_args = copy.copy(args)
+            session_args.label = label
+            if args.artifacts_dir:
+                session_args.artifacts_dir = os.path.join(args.artifacts_dir, label)
+            running[downloads.submit(tandem.download, session_args)] = (label, session_args, 'download')
+        while running:
+            done,_ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                label,session_args,stage = running.pop(future)
+                try:
+                    future.result()
+                except (Exception, SystemExit) as e:
+                    logger.error('failed to %s session %s: %s', stage, label, e)
+                    failed.append(label)
+                    continue
+                if stage == 'download':
+                    running[processing.submit(process.do, session_args)] = (label, session_args, 'process')
+                else:
+                    logger.info('finished session %s', label)
+    return failed
+
+def configure_worker(level, formatters):
+    '''
+    Log from a worker process to stderr the way the parent process does
+    '''
+    root = logging.getLogger()
+    root.setLevel(level)
+    for formatter in formatters:
+        handler = logging.StreamHandler()
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
@@ -0,0 +1,139 @@
+import os
+import json
+import glob
+import logging
+
+logger = logging.getLogger(__name__)
+
+# manifest file name, saved outside of the BIDS session directory
+MANIFEST = 'dwiqc-download.json'
+
+# derivatives directory that manifests are saved under, pybids ignores it
+MANIFEST_DIR = os.path.join('derivatives', 'dwiqc-downloads')
+
+class Manifest:
+    '''
+    Manifest of the scans downloaded into a BIDS session directory.
+
+    Every downloaded scan is recorded under its config label and run with
+    the XNAT scan ID, a stamp of its files on XNAT and the files it produced.
+    A scan is current when the recorded scan ID and remote stamp still match
+    and its files are on disk. The files themselves are not compared, since
+    prequal and qsiprep rewrite fieldmaps and their sidecars in place.
+
+    The manifest is saved under derivatives/dwiqc-downloads in the BIDS
+    directory rather than in the session directory itself.
+    '''
+    def __init__(self, session_dir):
+        self.session_dir = session_dir
+        ses = os.path.basename(session_dir)
+        sub = os.path.basename(os.path.dirname(session_dir))
+        bids = os.path.dirname(os.path.dirname(session_dir))
+        self.filename = os.path.join(bids, MANIFEST_DIR, sub, ses, MANIFEST)
+        self.scans = dict()
+        if os.path.exists(self.filename):
+            with open(self.filename) as fo:
+                self.scans = json.load(fo).get('scans', dict())
+
+    def key(self, run, scan_label):
+        return f'{scan_label}_run-{int(run)}'
+
+    def changed(self, run, scan, scan_label, remote=None):
+        '''
+        Return why a scan has to be downloaded or None when it is current
+        '''
+        entry = self.scans.get(self.key(run, scan_label))
+        if not entry:
+            return 'not downloaded yet'
+        if entry['scan'] != str(scan):
+            return f'scan changed from {entry["scan"]} to {scan}'
+        if remote and entry.get('remote') != remote:
+            return 'scan files changed on xnat'
+        for relpath in entry['files']:
+            if not os.path.exists(os.path.join(self.session_dir, relpath)):
+                return f'{relpath} is missing'
+        return None
+
+    def pending(self, downloads, remote=None):
+        '''
+        Filter (run, scan, scan_label) downloads down to the scans that are
+        missing or changed, removing the stale files of changed scans so
+        the new download does not collide with them. remote maps scan IDs
+        to their stamp on XNAT.
+        '''
+        remote = remote or dict()
+        pending = list()
+        for run,scan,scan_label in downloads:
+            reason = self.changed(run, scan, scan_label, remote.get(str(scan)))
+            if reason is None:
+                logger.info('skipping %s run=%s, scan=%s, already downloaded', scan_label, run, scan)
+                continue
+            logger.info('downloading %s run=%s, scan=%s, %s', scan_label, run, scan, reason)
+            self.discard(run, scan_label)
+            pending.append((run, scan, scan_label))
+        return pending
+
+    def discard(self, run, scan_label):
+        entry = self.scans.pop(self.key(run, scan_label), None)
+        if not entry:
+            return
+        for relpath in entry['files']:
+            fullfile = os.path.join(self.session_dir, relpath)
+            if os.path.exists(fullfile):
+                logger.debug('removing stale download %s', fullfile)
+                os.remove(fullfile)
+
+    def files(self, run, scan, bids_subdir):
+        '''
+        Files converted from an XNAT scan into its BIDS sub-directory, found
+        through the DataSource that is saved in every BIDS sidecar. Files
+        the pipeline derives from a scan in other sub-directories, such as
+        fieldmaps extracted from a dwi scan, are left out.
+        '''
+        pattern = os.path.join(self.session_dir, bids_subdir, f'*_run-{int(run)}_*.json')
+        files = list()
+        for sidecar in sorted(glob.glob(pattern)):
+            with open(sidecar) as fo:
+                js = json.load(fo, strict=False)
+            source = js.get('DataSource', dict()).get('application/x-xnat', dict())
+            if str(source.get('scan')) != str(scan):
+                continue
+            stem = os.path.splitext(sidecar)[0]
+            files.extend(sorted(glob.glob(f'{stem}.*')))
+        return files
+
+    def record(self, run, scan, scan_label, bids_subdir, remote=None):
+        '''
+        Record a scan right after it was downloaded
+        '''
+        files = self.files(run, scan, bids_subdir)
+        if not files:
+            logger.warning('no files found for %s run=%s, scan=%s, it will not be recorded', scan_label, run, scan)
+            return
+        self.scans[self.key(run, scan_label)] = {
+            'scan': str(scan),
+            'remote': remote,
+            'files': [os.path.relpath(f, self.session_dir) for f in files]
+        }
+
+    def stamps(self, bids_subdir):
+        '''
+        Scan ID and remote stamp of every recorded scan with files in a
+        BIDS sub-directory, by config label and run
+        '''
+        stamps = dict()
+        for key,entry in self.scans.items():
+            if any(f.startswith(bids_subdir + os.sep) for f in entry['files']):
+                stamps[key] = f'{entry["scan"]}:{entry.get("remote")}'
+        return stamps
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        tmp = f'{self.filename}.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump({'scans': self.scans}, fo, indent=2)
+        os.replace(tmp, self.filename)
+        # manifests used to be saved in the session directory itself
+        legacy = os.path.join(self.session_dir, MANIFEST)
+        if os.path.exists(legacy):
+            os.remove(legacy)
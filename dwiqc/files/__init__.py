@@ -0,0 +1,99 @@
+import os
+import re
+import fcntl
+import shutil
+import logging
+import collections as col
+
+logger = logging.getLogger(__name__)
+
+# linux ioctl that shares the extents of one file with another (reflink)
+FICLONE = 0x40049409
+
+def clone(src, dst):
+    '''
+    Copy src to dst as a reflink when the filesystem supports it, falling
+    back to a regular copy. Returns the method that was used.
+    '''
+    try:
+        with open(src, 'rb') as fi, open(dst, 'wb') as fo:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+        shutil.copystat(src, dst)
+        return 'reflink'
+    except OSError:
+        shutil.copy2(src, dst)
+        return 'copy'
+
+def link(src, dst):
+    '''
+    Hardlink src to dst, falling back to clone when src and dst are on
+    different filesystems or the filesystem does not support hardlinks.
+    Returns the method that was used.
+    '''
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        return clone(src, dst)
+
+def stage(src, dst, mode='copy'):
+    '''
+    Place src at dst, replacing anything already there. The mode is copy,
+    link (hardlink, then reflink) or symlink, and whatever cannot be linked
+    is copied. Returns the method that was used.
+    '''
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if mode == 'link':
+        return link(src, dst)
+    if mode == 'symlink':
+        try:
+            os.symlink(os.path.abspath(src), dst)
+            return 'symlink'
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+class Inventory:
+    '''
+    Names of the files in a directory, listed with a single os.scandir pass
+    and shared by every caller until the directory's mtime changes
+    '''
+    _cache = dict()
+
+    def __init__(self, directory):
+        self.directory = directory
+        mtime = os.stat(directory).st_mtime_ns
+        cached = Inventory._cache.get(directory)
+        if cached and cached[0] == mtime:
+            self.names = cached[1]
+            return
+        with os.scandir(directory) as it:
+            self.names = sorted(entry.name for entry in it if entry.is_file())
+        Inventory._cache[directory] = (mtime, self.names)
+
+    def by_suffix(self, suffixes):
+        '''
+        Classify file names through a lookup table keyed by suffix. Returns
+        a dict of suffix to the names that end with it.
+        '''
+        lengths = sorted({len(suffix) for suffix in suffixes}, reverse=True)
+        found = col.defaultdict(list)
+        for name in self.names:
+            for n in lengths:
+                if name[-n:] in suffixes:
+                    found[name[-n:]].append(name)
+        return found
+
+    def match(self, pattern):
+        '''
+        (name, match) for every file name that matches a regular expression
+        '''
+        regex = re.compile(pattern)
+        matches = list()
+        for name in self.names:
+            m = regex.match(name)
+            if m:
+                matches.append((name, m))
+        return matches
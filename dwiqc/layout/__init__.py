@@ -0,0 +1,183 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+import logging
+from bids import BIDSLayout, BIDSLayoutIndexer
+
+logger = logging.getLogger(__name__)
+
+# top-level files that take part in BIDS metadata inheritance
+TOPLEVEL_FILES = [
+    'dataset_description.json',
+    'participants.tsv',
+    'participants.json'
+]
+
+# default location of layout indexes, outside of any BIDS directory
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'dwiqc', 'layout')
+
+# unit holding the top-level files, a change to these affects every subject
+TOPLEVEL = '.'
+
+# pybids skips these locations by default, keep doing so for scoped layouts
+DEFAULT_IGNORE = [
+    re.compile(r'^/(code|models|sourcedata|stimuli)')
+]
+
+class Index:
+    '''
+    Shared BIDSLayout index for a BIDS directory.
+
+    The layout is built at most once per run and persisted to an on-disk
+    pybids database under ``~/.cache/dwiqc/layout``, outside of the BIDS
+    directory. The database is keyed by a fingerprint of the file list of
+    each subject and of the top-level files, and is indexed again by pybids
+    when any of them changed.
+
+    Passing ``sub`` (and optionally ``ses``) scopes the index to the
+    top-level dataset files plus that subject/session directory, so the
+    cost of indexing grows with the session rather than the dataset.
+    '''
+    def __init__(self, bids, sub=None, ses=None, cache_dir=None):
+        self.bids = os.path.abspath(bids)
+        self.sub = sub.replace('sub-', '') if sub else None
+        self.ses = ses.replace('ses-', '') if ses and sub else None
+        if not cache_dir:
+            dataset = hashlib.sha1(self.bids.encode('utf-8')).hexdigest()[:16]
+            cache_dir = os.path.join(CACHE_DIR, f'{os.path.basename(self.bids)}-{dataset}')
+            if self.scope:
+                cache_dir = os.path.join(cache_dir, self.scope.replace(os.sep, '_'))
+        self.cache_dir = cache_dir
+        self._layout = None
+        self._fingerprints = None
+
+    @property
+    def scope(self):
+        '''
+        Directory this index is restricted to, relative to the BIDS root
+        '''
+        if not self.sub:
+            return None
+        if not self.ses:
+            return f'sub-{self.sub}'
+        return os.path.join(f'sub-{self.sub}', f'ses-{self.ses}')
+
+    @property
+    def layout(self):
+        if self._layout is None:
+            self.refresh()
+        return self._layout
+
+    def units(self):
+        '''
+        Directories that are fingerprinted and indexed on their own, every
+        subject or just the scoped directory
+        '''
+        if self.scope:
+            return [self.scope]
+        with os.scandir(self.bids) as it:
+            return sorted(e.name for e in it if e.name.startswith('sub-') and e.is_dir())
+
+    def files(self, unit):
+        '''
+        List the files of a unit as (relpath, size) tuples. Sizes are used
+        instead of modification times since the tasks rewrite fieldmaps and
+        sidecars in place on every run.
+        '''
+        if unit != TOPLEVEL:
+            return self.walk(os.path.join(self.bids, unit))
+        files = list()
+        for name in TOPLEVEL_FILES:
+            fullfile = os.path.join(self.bids, name)
+            if os.path.isfile(fullfile):
+                files.append((name, os.stat(fullfile).st_size))
+        return files
+
+    def walk(self, path):
+        files = list()
+        for root, dirs, filenames in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for filename in sorted(filenames):
+                if filename.startswith('.'):
+                    continue
+                fullfile = os.path.join(root, filename)
+                relpath = os.path.relpath(fullfile, self.bids)
+                files.append((relpath, os.stat(fullfile).st_size))
+        return files
+
+    def indexer(self):
+        '''
+        Build a pybids indexer that ignores every subject and session
+        outside of this index's scope
+        '''
+        if not self.scope:
+            return None
+        ignore = list(DEFAULT_IGNORE)
+        sub = re.escape(self.sub)
+        ignore.append(re.compile(rf'^/sub-(?!{sub}(/|$))'))
+        if self.ses:
+            ses = re.escape(self.ses)
+            ignore.append(re.compile(rf'^/sub-{sub}/ses-(?!{ses}(/|$))'))
+        return BIDSLayoutIndexer(validate=True, ignore=ignore)
+
+    def fingerprint(self, unit):
+        sha = hashlib.sha1()
+        for relpath,size in self.files(unit):
+            sha.update(f'{relpath}\0{size}\n'.encode('utf-8'))
+        return sha.hexdigest()
+
+    def fingerprints(self, sub=None):
+        '''
+        Fingerprint the top-level files and every unit. Once the layout is
+        loaded, passing sub only fingerprints that subject again and keeps
+        the fingerprints of the others.
+        '''
+        unit = f'sub-{sub.replace("sub-", "")}' if sub else None
+        if self._fingerprints is None or self.scope or not unit:
+            units = [TOPLEVEL] + self.units()
+            return {u: self.fingerprint(u) for u in units}
+        fingerprints = dict(self._fingerprints)
+        fingerprints[TOPLEVEL] = self.fingerprint(TOPLEVEL)
+        if os.path.isdir(os.path.join(self.bids, unit)):
+            fingerprints[unit] = self.fingerprint(unit)
+        else:
+            fingerprints.pop(unit, None)
+        return fingerprints
+
+    def refresh(self, sub=None):
+        '''
+        Return an up to date layout, loading it from the on-disk database
+        when the dataset is unchanged and indexing it again otherwise. Pass
+        sub when only that subject could have changed since the layout was
+        loaded, to avoid walking the whole dataset again.
+        '''
+        fingerprints = self.fingerprints(sub)
+        if self._layout is not None and fingerprints == self._fingerprints:
+            logger.debug('bids layout for %s is up to date', self.bids)
+            return self._layout
+        os.makedirs(self.cache_dir, exist_ok=True)
+        database = os.path.join(self.cache_dir, 'database')
+        sidecar = os.path.join(self.cache_dir, 'fingerprint.json')
+        lockfile = os.path.join(self.cache_dir, 'lock')
+        # serialize index builds across concurrent dwiqc processes
+        with open(lockfile, 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                cached = dict()
+                if os.path.exists(sidecar):
+                    with open(sidecar) as fo:
+                        cached = json.load(fo)
+                if cached.get('root') == self.bids and cached.get('fingerprints') == fingerprints:
+                    logger.info('loading bids layout for %s from %s', self.bids, database)
+                    self._layout = BIDSLayout(self.bids, database_path=database)
+                else:
+                    logger.info('indexing bids layout for %s into %s', self.bids, database)
+                    self._layout = BIDSLayout(self.bids, database_path=database, reset_database=True, indexer=self.indexer())
+                    with open(sidecar, 'w') as fo:
+                        json.dump({'root': self.bids, 'fingerprints': fingerprints}, fo, indent=2)
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        self._fingerprints = fingerprints
+        return self._layout
@@ -0,0 +1,80 @@
+import os
+import logging
+import tempfile
+import functools
+import numpy as np
+import nibabel as nib
+from nibabel.filebasedimages import ImageFileError
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+class VolumeError(Exception):
+    pass
+
+Header = namedtuple('Header', ['shape', 'dims', 'pixdim', 'dtype', 'volumes'])
+
+# failures of the native engine that callers fall back to FSL for
+ERRORS = (VolumeError, ImageFileError, OSError, ValueError, MemoryError)
+
+def inspect(path):
+    '''
+    Shape, number of dimensions, voxel sizes, data type and number of
+    volumes of a NIfTI image, read from its header alone. Results are
+    cached by path, size and modification time.
+    '''
+    st = os.stat(path)
+    return _inspect(os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+@functools.lru_cache(maxsize=256)
+def _inspect(path, size, mtime):
+    header = nib.load(path).header
+    shape = header.get_data_shape()
+    return Header(
+        shape=shape,
+        dims=len(shape),
+        pixdim=header.get_zooms(),
+        dtype=header.get_data_dtype(),
+        volumes=shape[3] if len(shape) > 3 else 1
+    )
+
+def select_volumes(infile, outfile, volumes):
+    '''
+    Write the given volumes of a NIfTI image to outfile, in the order given,
+    like fslselectvols. Only the selected volumes are read through the
+    image proxy and the result is moved into place once written, so infile
+    and outfile may be the same file.
+    '''
+    img = nib.load(infile)
+    volumes = [int(v) for v in volumes]
+    if not volumes:
+        raise VolumeError(f'no volumes to select from {infile}')
+    nvols = img.shape[3] if len(img.shape) > 3 else 1
+    invalid = [v for v in volumes if not 0 <= v < nvols]
+    if invalid:
+        raise VolumeError(f'{infile} has {nvols} volumes, cannot select {invalid}')
+    if len(img.shape) > 3:
+        data = np.stack([np.asanyarray(img.dataobj[..., v]) for v in volumes], axis=-1)
+    elif len(volumes) == 1:
+        data = np.asanyarray(img.dataobj)
+    else:
+        data = np.stack([np.asanyarray(img.dataobj)] * len(volumes), axis=-1)
+    out = img.__class__(data, img.affine, img.header.copy())
+    out.set_data_dtype(img.get_data_dtype())
+    save(out, outfile)
+    logger.debug('selected volumes %s of %s into %s', volumes, infile, outfile)
+
+def save(img, outfile):
+    '''
+    Save an image next to outfile and rename it into place
+    '''
+    outfile = str(outfile)
+    suffix = '.nii.gz' if outfile.endswith('.gz') else '.nii'
+    fd,tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)), suffix=suffix)
+    os.close(fd)
+    try:
+        nib.save(img, tmp)
+        os.replace(tmp, outfile)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,151 @@
+import time
+import logging
+import collections as col
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+class Stage:
+    '''
+    A unit of post-processing that runs on the driver once its parent jobs
+    have completed and its parent stages have succeeded
+    '''
+    def __init__(self, name, func, jobs=None, after=None, inline=False):
+        self.name = name
+        self.func = func
+        self.jobs = list(jobs) if jobs else list()
+        self.after = list(after) if after else list()
+        self.inline = inline
+        self.future = None
+        self.skipped = False
+
+    @property
+    def done(self):
+        if self.skipped:
+            return True
+        return self.future is not None and self.future.done()
+
+    @property
+    def ok(self):
+        if not self.done or self.skipped:
+            return False
+        return self.future.exception() is None
+
+    def ready(self, jarray):
+        for job in self.jobs:
+            if job.pid not in jarray.complete:
+                return False
+        for stage in self.after:
+            if not stage.ok:
+                return False
+        return True
+
+    def blocked(self, jarray):
+        for job in self.jobs:
+            if job.pid in jarray.failed:
+                return True
+        for stage in self.after:
+            if stage.done and not stage.ok:
+                return True
+        return False
+
+class Pipeline:
+    '''
+    Submit the jobs of a job array and start each downstream stage the moment
+    the jobs it depends on have completed, while other jobs are still in
+    flight. Stages run concurrently on a thread pool unless they are marked
+    inline, in which case they run on the polling thread.
+    '''
+    def __init__(self, jarray, workers=4, poll=30):
+        self.jarray = jarray
+        self.workers = workers
+        self.poll = poll
+        self.stages = list()
+
+    def add(self, job):
+        self.jarray.add(job)
+
+    def stage(self, name, func, jobs=None, after=None, inline=False):
+        stage = Stage(name, func, jobs=jobs, after=after, inline=inline)
+        self.stages.append(stage)
+        return stage
+
+    @property
+    def failed(self):
+        return [stage for stage in self.stages if stage.done and not stage.ok and not stage.skipped]
+
+    @property
+    def skipped(self):
+        return [stage for stage in self.stages if stage.skipped]
+
+    def run(self, limit=None):
+        '''
+        Submit every job, respecting the limit on concurrently running jobs,
+        and block until all jobs and stages have finished.
+        '''
+        jarray = self.jarray
+        if not limit:
+            limit = len(jarray.array)
+        queue = col.deque(jarray.array)
+        pending = list(self.stages)
+        logger.info('submitting %s jobs', len(queue))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while 1:
+                while queue and len(jarray.running) < limit:
+                    job = queue.popleft()
+                    jarray.E.submit(job)
+                    jarray.running[job.pid] = job
+                    logger.debug('%s was submitted with pid %s', job.name, job.pid)
+                if jarray.running:
+                    jarray.update()
+                for stage in list(pending):
+                    if stage.blocked(jarray):
+                        logger.warning('skipping %s since an upstream job or stage failed', stage.name)
+                        stage.skipped = True
+                        pending.remove(stage)
+                    elif stage.ready(jarray):
+                        logger.info('starting %s', stage.name)
+                        pending.remove(stage)
+                        if stage.inline:
+                            stage.future = self._inline(stage)
+                        else:
+                            stage.future = pool.submit(stage.func)
+                if not queue and not jarray.running and all(stage.done for stage in self.stages):
+                    break
+                time.sleep(self.poll if jarray.running else 1)
+        for stage in self.failed:
+            e = stage.future.exception()
+            logger.error('%s failed: %s', stage.name, repr(e))
+
+    def _inline(self, stage):
+        future = Future()
+        try:
+            future.set_result(stage.func())
+        except (Exception, SystemExit) as e:
+            future.set_exception(e)
+        return future
+
+class Parents:
+    '''
+    Parent of a job that has to wait on several jobs. The scheduler
+    dependency is rendered from ``pid``, so this yields ``afterok:1:2``
+    which Slurm and PBS read as "after all of these jobs succeeded".
+    '''
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+
+    @property
+    def pid(self):
+        return ':'.join(str(job.pid) for job in self.jobs)
+
+def submit(E, jobs):
+    '''
+    Submit jobs in order without waiting for any of them. Every parent has
+    to appear before its children so its pid is known at submission time.
+    '''
+    for job in jobs:
+        E.submit(job)
+        if job.parent:
+            logger.info('%s was submitted with pid %s after %s', job.name, job.pid, job.parent.pid)
+        else:
+            logger.info('%s was submitted with pid %s', job.name, job.pid)
@@ -0,0 +1,128 @@
+import os
+import re
+import sys
+import json
+import shutil
+import signal
+import logging
+import tempfile
+import argparse as ap
+import subprocess as sp
+
+logger = logging.getLogger(__name__)
+
+class ScratchError(Exception):
+    pass
+
+class Plan:
+    '''
+    What a job stages into node-local scratch before its command runs and
+    what it rsyncs back to shared storage afterwards.
+
+    Each path is a shared directory with a name under scratch, whether it
+    is staged in, out or both, and rsync filter rules. Every occurrence of
+    a shared path in the command and in SINGULARITY_BIND is replaced with
+    its scratch copy. The plan is saved as JSON next to the job logs and
+    carried out on the node by python -m dwiqc.scratch. Environment
+    variables in root are expanded on the node.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.paths = list()
+
+    def add(self, path, name, stage_in=True, stage_out=True, filters=()):
+        self.paths.append({
+            'path': os.path.abspath(path),
+            'name': name,
+            'in': stage_in,
+            'out': stage_out,
+            'filters': list(filters)
+        })
+        return self
+
+    def wrap(self, command, planfile):
+        '''
+        Save the plan for command and return the command that runs it in
+        scratch on the node
+        '''
+        os.makedirs(os.path.dirname(planfile), exist_ok=True)
+        with open(planfile, 'w') as fo:
+            json.dump({'root': self.root, 'paths': self.paths, 'command': command}, fo, indent=2)
+        return [sys.executable, '-m', 'dwiqc.scratch', planfile]
+
+def run(planfile):
+    '''
+    Stage in, run the command against scratch, stage out and clean up.
+    Outputs are staged out even when the command fails, so failed runs can
+    be inspected. Returns the command returncode.
+    '''
+    with open(planfile) as fo:
+        plan = json.load(fo)
+    root = os.path.expandvars(plan['root'])
+    os.makedirs(root, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='dwiqc-', dir=root)
+    logger.info('using scratch directory %s', scratch)
+    try:
+        paths = [(p, os.path.join(scratch, p['name'])) for p in plan['paths']]
+        for p,local in paths:
+            os.makedirs(local, exist_ok=True)
+            if p['in'] and os.path.isdir(p['path']):
+                rsync(p['path'], local, p['filters'], '--copy-links')
+        mapping = {p['path']: local for p,local in paths}
+        command = [localize(arg, mapping) for arg in plan['command']]
+        env = dict(os.environ)
+        # shared paths stay bound, for files that refer to them by name
+        bind = [b for b in env.get('SINGULARITY_BIND', '').split(',') if b]
+        bind = bind + [localize(b, mapping) for b in bind] + [scratch]
+        env['SINGULARITY_BIND'] = ','.join(dict.fromkeys(bind))
+        logger.info('running %s', sp.list2cmdline(command))
+        returncode = sp.call(command, env=env)
+        logger.info('command exited with returncode=%s', returncode)
+        for p,local in paths:
+            if p['out']:
+                os.makedirs(p['path'], exist_ok=True)
+                rsync(local, p['path'], p['filters'], '--copy-unsafe-links')
+    finally:
+        logger.info('removing scratch directory %s', scratch)
+        shutil.rmtree(scratch, ignore_errors=True)
+    return returncode
+
+def localize(arg, mapping):
+    '''
+    Replace shared paths in a command line argument with their scratch
+    copies, longest first and in one pass, since scratch may be below a
+    shared path
+    '''
+    if not mapping:
+        return arg
+    shared = sorted(mapping, key=len, reverse=True)
+    pattern = '|'.join(re.escape(path) for path in shared)
+    return re.sub(rf'({pattern})(?=[/:,]|$)', lambda m: mapping[m.group(1)], arg)
+
+def rsync(src, dst, filters, *options):
+    cmd = ['rsync', '-a', '--prune-empty-dirs', *options]
+    cmd.extend(f'--filter={rule}' for rule in filters)
+    cmd.extend([f'{src}/', f'{dst}/'])
+    logger.info('running %s', sp.list2cmdline(cmd))
+    try:
+        sp.check_output(cmd, stderr=sp.STDOUT)
+    except sp.CalledProcessError as e:
+        raise ScratchError(f'failed to stage {src} to {dst}: {e.output.decode(errors="replace")}')
+    except OSError as e:
+        raise ScratchError(f'failed to run rsync: {e}')
+
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+def main(argv=None):
+    parser = ap.ArgumentParser(description='Run a dwiqc job in node-local scratch')
+    parser.add_argument('plan', help='Scratch plan saved by dwiqc.scratch.Plan')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    # clean up scratch when the scheduler ends the job
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        return run(args.plan)
+    except ScratchError as e:
+        logger.critical(e)
+        return 1
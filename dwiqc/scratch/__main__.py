@@ -0,0 +1,4 @@
+import sys
+from dwiqc.scratch import main
+
+sys.exit(main())
@@ -0,0 +1,66 @@
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+class TagMatcher:
+    '''
+    Every tag pattern of a download config compiled into one expression.
+
+    Each label is an optional lookahead anchored at the start of the note,
+    so a single match classifies a note against every label at once while
+    keeping the behavior of matching each label on its own. Within a label
+    the first pattern that matches wins, as it did with re.match.
+    '''
+    def __init__(self, labels):
+        self.labels = list()
+        self.runs = dict()
+        groups = list()
+        for j,(label,conf) in enumerate(labels.items()):
+            if 'tag' not in conf:
+                continue
+            alternatives = list()
+            for i,pattern in enumerate(conf['tag']):
+                prefix = f't{j}_{i}'
+                alternatives.append(f'(?P<{prefix}>{scope(rename(pattern, prefix))})')
+                if re.search(r'\(\?P<run>', pattern):
+                    self.runs[prefix] = f'{prefix}_run'
+            self.labels.append((label, [f't{j}_{i}' for i in range(len(conf['tag']))]))
+            groups.append('(?:(?={0}))?'.format('|'.join(alternatives)))
+        self.regex = re.compile(''.join(groups), flags=re.IGNORECASE)
+        self._cache = dict()
+
+    def classify(self, note):
+        '''
+        Return a dict of every label whose tag matches the note, mapped to
+        the run captured by the matching pattern (or None)
+        '''
+        if note in self._cache:
+            return self._cache[note]
+        m = self.regex.match(note)
+        tags = dict()
+        for label,prefixes in self.labels:
+            for prefix in prefixes:
+                if m.group(prefix) is not None:
+                    run = self.runs.get(prefix)
+                    tags[label] = m.group(run) if run else None
+                    break
+        self._cache[note] = tags
+        return tags
+
+def rename(pattern, prefix):
+    '''
+    Prefix the named groups of a pattern so they are unique once combined
+    '''
+    pattern = re.sub(r'\(\?P<(\w+)>', rf'(?P<{prefix}_\1>', pattern)
+    return re.sub(r'\(\?P=(\w+)\)', rf'(?P={prefix}_\1)', pattern)
+
+def scope(pattern):
+    '''
+    Turn leading inline flags such as (?i) into a scoped group, since global
+    flags are only allowed at the start of the combined expression
+    '''
+    m = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+    if m:
+        return f'(?{m.group(1)}:{pattern[m.end():]})'
+    return f'(?:{pattern})'
@@ -9,25 +9,33 @@ import json
 import shutil
 import logging
 import tempfile
+import collections as col
 import subprocess
 import numpy as np
-import nibabel as nib
 from pathlib import Path
 from pprint import pprint
 from random import randint
-from bids import BIDSLayout
 import dwiqc.tasks as tasks
+import dwiqc.nifti as nifti
+import dwiqc.files as files
+import dwiqc.cache as cache
 import dwiqc.config as config
+from dwiqc.layout import Index
 from datetime import datetime
 from executors.models import Job
+from dwiqc.scratch import Plan
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
+# concurrent fieldmap preparation and file copies when staging INPUTS
+STAGING_WORKERS = 4
+
 
 # pull in some parameters from the BaseTask class in the __init__.py directory
 
 class Task(tasks.BaseTask):
-    def __init__(self, sub, ses, run, bids, outdir, prequal_config, fs_license, custom_eddy_stdev, slurm_job_id, container_dir=None, no_gpu=False, tempdir=None, pipenv=None):
+    def __init__(self, sub, ses, run, bids, outdir, prequal_config, fs_license, custom_eddy_stdev, slurm_job_id, container_dir=None, no_gpu=False, index=None, cache=None, inputs_staging='copy', scratch=None, tempdir=None, pipenv=None):
         self._sub = sub
         self._ses = ses
         self._run = run
@@ -38,8 +46,14 @@ class Task(tasks.BaseTask):
         self._custom_eddy = custom_eddy_stdev
         self._slurm_job_id = slurm_job_id
         self._no_gpu = no_gpu
-        self._layout = BIDSLayout(bids)
+        self._index = index if index else Index(bids, sub=sub, ses=ses)
+        self._layout = self._index.layout
         self._date = datetime.today().strftime('%Y-%m-%d')
+        self._cache = cache
+        self._inputs_staging = inputs_staging
+        self._scratch = scratch
+        self.cache_key = None
+        self.cached = False
         super().__init__(outdir, tempdir, pipenv)
 
 
@@ -54,72 +68,63 @@ class Task(tasks.BaseTask):
         if not fmap_files:
             fmap_files = self._layout.get(subject=self._sub, session=self._ses, suffix='epi', extension='.nii', return_type='filename')
         
-        # Only truncate fmaps if they exist
         if fmap_files:
-            truncated_fmaps = self.truncate_fmaps(fmap_files, inputs_dir)
+            self.get_fsl_sif()
         else:
-            truncated_fmaps = []
             logger.info('No fieldmaps found - skipping fieldmap truncation')
             self._nonzero_shells = False
-            self.create_spec(inputs_dir)
-        
-        # Copy all the subject's files into the INPUTS directory
-        for file in all_files:
-            basename = os.path.basename(file)
-            dest = os.path.join(inputs_dir, basename)
-            shutil.copy(file, dest)
-        
-        # Only create bfiles if we have fieldmaps
-        if truncated_fmaps:
-            self.create_bfiles(inputs_dir, truncated_fmaps)
-        
+
+        # fieldmaps are truncated, copied and given dummy bfiles while the
+        # rest of the subject's images are staged into the INPUTS directory.
+        # images are never modified in place, so they may be links, but small
+        # sidecars are always copied since qsiprep edits fieldmap sidecars
+        fmap_stems = {os.path.basename(fmap).split('.', 1)[0] for fmap in fmap_files}
+        staged = col.Counter()
+        with ThreadPoolExecutor(max_workers=STAGING_WORKERS) as pool:
+            futures = [pool.submit(self.prepare_fmap, fmap, inputs_dir) for fmap in fmap_files]
+            for file in all_files:
+                # fieldmaps and their bfiles are written by prepare_fmap
+                stem,_,ext = os.path.basename(file).partition('.')
+                if stem in fmap_stems and ext in ('nii.gz', 'nii', 'bval', 'bvec'):
+                    continue
+                dest = os.path.join(inputs_dir, os.path.basename(file))
+                mode = self._inputs_staging if ext in ('nii.gz', 'nii') else 'copy'
+                futures.append(pool.submit(files.stage, file, dest, mode))
+            for future in futures:
+                staged[future.result()] += 1
+        logger.info('staged %s inputs with %s staging: %s', sum(staged.values()), self._inputs_staging,
+            ', '.join(f'{n} {method}' for method,n in sorted(staged.items())))
+
+        self.create_spec(inputs_dir)
+
+    def prepare_fmap(self, fmap, inputs_dir):
+        self.truncate_fmap(fmap)
+        method = files.stage(fmap, os.path.join(inputs_dir, os.path.basename(fmap)), 'copy')
+        self.write_bfiles(inputs_dir, fmap)
+        return method
 
     # the fieldmap data needs accompanying 'dummy' bval and bvec files that consist of 0's
     def create_bfiles(self, inputs_dir, truncated_fmaps):
-        # get a list of all the fmap files that end with .json (this it's helpful to have a file with just one extension)
+        for fmap in truncated_fmaps:
+            self.write_bfiles(inputs_dir, fmap)
+
+        self.create_spec(inputs_dir)
 
+    def write_bfiles(self, inputs_dir, fmap):
         # get the basename of the file and then remove the extension
-        for fmap in truncated_fmaps:
+        no_ext = os.path.basename(fmap).split('.', 1)[0]
 
-            basename = os.path.basename(fmap)
+        # get the number of volumes in the data file from its header
+        num_vols = nifti.inspect(fmap).volumes
 
-            no_ext = basename.split('.', 1)[0]
+        # a .bval file with a 0 for every volume and a .bvec file with three rows of them
+        zeros = ' '.join(['0'] * num_vols) + '\n'
 
-            # get the number of volumes in the data file
-            try:
-                num_vols = nib.load(fmap).shape[3]
-            except IndexError:
-                num_vols = 1
-
-            # create a .bval file same number of rows of 0 as there are volumes
-
-            with open(f'{inputs_dir}/{no_ext}.bval', 'w') as bval:
-                rows_written = 0
-                while rows_written < num_vols:
-                    if rows_written == 0:
-                        bval.write('0')
-                    elif rows_written == num_vols - 1:
-                        bval.write(' 0\n')
-                    else:
-                        bval.write(' 0')
-                    rows_written += 1
-
-            # create .bvec file with 3 row 0's equal to the number of volumes
-
-            with open(f'{inputs_dir}/{no_ext}.bvec', 'w') as bvec:
-                row_to_write = ''
-                # write the same number of 0's as there are volumes
-                for _ in range(num_vols):
-                    row_to_write += '0 '
-                # remove any trailing whitespace
-                row_to_write = row_to_write.strip()
-
-                # add three rows to bvec file
-                for _ in range(3):      
-                    bvec.write(f'{row_to_write}\n')
+        with open(f'{inputs_dir}/{no_ext}.bval', 'w') as bval:
+            bval.write(zeros)
 
-        self.create_spec(inputs_dir)
-        
+        with open(f'{inputs_dir}/{no_ext}.bvec', 'w') as bvec:
+            bvec.write(zeros * 3)
 
 
     # this method serves to create the accompanying spec file for prequal 
@@ -134,33 +139,43 @@ class Task(tasks.BaseTask):
         truncated_fmaps = []
 
         for fmap in fmap_files:
-            fmap_basename = os.path.basename(fmap)
-            fmap_dir = os.path.dirname(fmap)
-            cmd = [
-                'singularity',
-                'exec',
-                '--pwd', fmap_dir,
-                self._fsl_sif,
-                '/APPS/fsl/bin/fslselectvols',
-                '-i', fmap_basename,
-                '-o', fmap_basename,
-                '--vols=0'
-            ]
-            #logger.info(f'running {json.dumps(cmd, indent=2)} on {fmap}')
-
-            cmdline = subprocess.list2cmdline(cmd)
-            logger.info(f'running {cmdline}')
-            proc = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE)
-            proc.communicate()
-            if proc.returncode > 0:
-                logger.critical(f'fslselectvols command failed')
-                raise subprocess.CalledProcessError(returncode=proc.returncode, cmd=cmdline)
-
-            truncated_fmaps.append(fmap_dir + f'/{fmap_basename}')
-
+            self.truncate_fmap(fmap)
+            truncated_fmaps.append(fmap)
 
         return truncated_fmaps
 
+    def truncate_fmap(self, fmap):
+        """
+        keep the first volume of a fieldmap, selected in process with nibabel
+        and with fslselectvols as the fallback
+        """
+        try:
+            nifti.select_volumes(fmap, fmap, [0])
+            logger.info(f'selected volume 0 of {fmap}')
+        except nifti.ERRORS as e:
+            logger.warning(f'native volume selection failed for {fmap}, falling back to fslselectvols: {e}')
+            self.run_fslselectvols(fmap)
+
+    def run_fslselectvols(self, fmap):
+        fmap_basename = os.path.basename(fmap)
+        fmap_dir = os.path.dirname(fmap)
+        cmd = [
+            'singularity',
+            'exec',
+            '--pwd', fmap_dir,
+            self._fsl_sif,
+            '/APPS/fsl/bin/fslselectvols',
+            '-i', fmap_basename,
+            '-o', fmap_basename,
+            '--vols=0'
+        ]
+        cmdline = subprocess.list2cmdline(cmd)
+        logger.info(f'running {cmdline}')
+        proc = subprocess.Popen(cmdline, shell=True, stdout=subprocess.PIPE)
+        proc.communicate()
+        if proc.returncode > 0:
+            logger.critical(f'fslselectvols command failed')
+            raise subprocess.CalledProcessError(returncode=proc.returncode, cmd=cmdline)
 
     def get_fsl_sif(self):
 
@@ -673,6 +688,35 @@ class Task(tasks.BaseTask):
         self._command.append('--synb0')
         self._command.append('raw')
 
+    # restore the outputs from the result cache if these inputs were processed before
+
+    def check_cache(self, prequal_sif):
+        # everything after the container image is passed to prequal itself
+        options = self._command[self._command.index(prequal_sif)+1:]
+        inputs = dict()
+        for name in os.listdir(self._inputs_dir):
+            path = os.path.join(self._inputs_dir, name)
+            if os.path.isfile(path):
+                inputs[name] = path
+        self.cache_key = self._cache.key(prequal_sif, inputs, task='prequal', options=options)
+        if self._cache.restore(self.cache_key, self._outdir):
+            self.cached = True
+            with open(self._prov, 'w') as fo:
+                json.dump(self._cache.provenance(self.cache_key), fo, indent=2)
+        # track after restoring, a miss unshares outdir from the previously tracked entry
+        cache.track(self._outdir, self.cache_key)
+
+    # run prequal against node-local scratch, INPUTS are staged in and OUTPUTS are staged back out
+
+    def use_scratch(self):
+        plan = Plan(self._scratch)
+        plan.add(self._inputs_dir, 'INPUTS', stage_out=False)
+        plan.add(self._outdir, 'OUTPUTS', filters=['- /logs/'])
+        plan.add(self._tempdir, 'tmp', stage_in=False, stage_out=False)
+        start = self._command.index('singularity')
+        planfile = os.path.join(self.logdir(), 'dwiqc-prequal-scratch.json')
+        self._command = self._command[:start] + plan.wrap(self._command[start:], planfile)
+
     # build the prequal sbatch command and create job
 
     def build(self):
@@ -782,6 +826,10 @@ class Task(tasks.BaseTask):
 
         logdir = self.logdir()
         logfile = os.path.join(logdir, 'dwiqc-prequal.log')
+        if self._cache:
+            self.check_cache(prequal_sif)
+        if self._scratch:
+            self.use_scratch()
         if self._no_gpu:
             self.job = Job(
                 name='dwiqc-prequal',
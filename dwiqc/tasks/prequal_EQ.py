@@ -3,6 +3,7 @@ import os
 import time
 import sys
 import dwiqc.tasks as tasks
+import dwiqc.nifti as nifti
 import logging
 import subprocess
 import json
@@ -40,7 +41,7 @@ class Task(tasks.BaseTask):
 
 			self._fsl_sif = os.path.join(home_dir, '.config/dwiqc/containers/fsl_6.0.7.16.sif')
 
-		os.chdir(f"{self._outdir}/EDDY")
+		self._eddy_dir = f"{self._outdir}/EDDY"
 
 		# define log file
 		logging.basicConfig(filename=f"{self._outdir}/logs/dwiqc-prequal.log", encoding='utf-8', level=logging.DEBUG)
@@ -105,17 +106,17 @@ class Task(tasks.BaseTask):
 	def rename_eddy_files(self):
 		# rename all the eddy_results files to be {self._sub}_{self._ses}_{run}
 
-		os.chdir(f"{self._outdir}/EDDY")
+		eddy_dir = self._eddy_dir
 
-		for file in os.listdir():
+		for file in os.listdir(eddy_dir):
 			if file.startswith("eddy_results"):
 				new_name = file.replace("eddy_results", f"{self._sub}_{self._ses}")
-				os.rename(file, new_name)
+				os.rename(f'{eddy_dir}/{file}', f'{eddy_dir}/{new_name}')
 			elif file == 'dwmri.nii.gz':
 				new_name = f"{self._sub}_{self._ses}.nii.gz"
-				os.rename(file, new_name)
+				os.rename(f'{eddy_dir}/{file}', f'{eddy_dir}/{new_name}')
 			elif file.endswith('_preproc.nii.gz'):
-				os.rename(file, f"{self._sub}_{self._ses}.nii.gz")
+				os.rename(f'{eddy_dir}/{file}', f'{eddy_dir}/{self._sub}_{self._ses}.nii.gz')
 
 	def copy_nii(self, nii):
 		shutil.copy(f'{self._outdir}/PREPROCESSED/{nii}', f'{self._outdir}/EDDY/{self._sub}_{self._ses}.nii.gz')
@@ -143,12 +144,14 @@ class Task(tasks.BaseTask):
 
 		logger.info(f'{json.dumps(eddy_quad, indent=2)}')
 
-		if os.path.isdir(f'{self._sub}_{self._ses}.qc'):
+		qc_dir = f'{self._eddy_dir}/{self._sub}_{self._ses}.qc'
+
+		if os.path.isdir(qc_dir):
 			logging.warning('Output directory already exists. Removing and trying again.')
-			shutil.rmtree(f'{self._sub}_{self._ses}.qc')
+			shutil.rmtree(qc_dir)
 
 		logging.info('Running eddy_quad...')
-		proc1 = subprocess.Popen(eddy_quad, shell=True, stdout=subprocess.PIPE)
+		proc1 = subprocess.Popen(eddy_quad, shell=True, stdout=subprocess.PIPE, cwd=self._eddy_dir)
 		proc1.communicate()
 		code = proc1.returncode
 
@@ -220,7 +223,7 @@ class Task(tasks.BaseTask):
 		## Write out all these values to json file
 
 
-		with open('eddy_metrics.json', 'w') as outfile:
+		with open(os.path.join(os.path.dirname(eddy_dir), 'eddy_metrics.json'), 'w') as outfile:
 			json.dump(metrics_dict, outfile, indent=1)
 
 		logging.info('successfully parsed json and wrote out results to eddy_metrics.json')
@@ -231,9 +234,11 @@ class Task(tasks.BaseTask):
 		if not os.path.exists(dwmri):
 			raise FileNotFoundError(dwmri)
 		logger.info(f'found input file "{dwmri}"')
+		preproc_dir = f'{self._outdir}/PREPROCESSED'
+		if self.select_b0_volume(dwmri, os.path.join(preproc_dir, 'b0_volume.nii.gz')):
+			return
 		bindings = os.environ.get('SINGULARITY_BIND', None)
 		logger.info(f'SINGULARITY_BIND environment variable is set to "{bindings}"')
-		preproc_dir = f'{self._outdir}/PREPROCESSED'
 		cmd = [
 			'singularity',
 			'exec',
@@ -263,6 +268,8 @@ class Task(tasks.BaseTask):
 		logger.info(f'SINGULARITY_BIND environment variable is set to "{bindings}"')
 		preproc_dir = f'{self._outdir}/PREPROCESSED'
 		for scan in scans:
+			if self.select_b0_volume(os.path.join(preproc_dir, scan), os.path.join(preproc_dir, 'b0_volume.nii.gz')):
+				continue
 			cmd = [
 				'singularity',
 				'exec',
@@ -287,6 +294,19 @@ class Task(tasks.BaseTask):
 				raise FileNotFoundError(b0vol)
 			logger.info(f'found output file "{b0vol}"')
 
+	def select_b0_volume(self, infile, b0vol):
+		'''
+		Select the first volume in process, returns False when fslselectvols
+		should be used instead
+		'''
+		try:
+			nifti.select_volumes(infile, b0vol, [0])
+		except nifti.ERRORS as e:
+			logger.warning(f'native volume selection failed for {infile}, falling back to fslselectvols: {e}')
+			return False
+		logger.info(f'found output file "{b0vol}"')
+		return True
+
 	def bind_environmentals(self):
 	
 		bind = [self._bids, self._tempdir]
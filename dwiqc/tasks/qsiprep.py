@@ -9,14 +9,16 @@ import shutil
 import logging
 import subprocess
 import numpy as np
-import nibabel as nib
 from pprint import pprint
 from random import randint
 import dwiqc.tasks as tasks
-from bids import BIDSLayout
+import dwiqc.nifti as nifti
+import dwiqc.cache as cache
 import dwiqc.config as config
+from dwiqc.layout import Index
 from datetime import datetime
 from executors.models import Job
+from dwiqc.scratch import Plan
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 
@@ -24,9 +26,32 @@ date = datetime.today().strftime('%Y-%m-%d')
 
 logger = logging.getLogger(__name__)
 
+# work files qsiprep_EQ copies for eddy_quad, the rest of the work tree stays in scratch
+EDDY_ARTIFACTS = [
+	'+ */',
+	'+ hmc_sdc_wf/eddy/eddy*',
+	'+ hmc_sdc_wf/gather_inputs/eddy*.txt',
+	'+ hmc_sdc_wf/pre_eddy_b0_ref_wf/synthstrip_wf/mask_to_original_grid/topup_imain_corrected_avg_trans_mask_trans.nii.gz',
+	'+ hmc_sdc_wf/topup/fieldmap_HZ.nii.gz',
+	'- *'
+]
+
+
+# generated slice order and eddy parameters, written per session since
+# sessions in a batch share the BIDS directory
+
+def eddy_config_dir(outdir):
+	return os.path.join(outdir, 'eddy_config')
+
+def slspec(outdir):
+	return os.path.join(eddy_config_dir(outdir), 'slspec.txt')
+
+def eddy_params(outdir):
+	return os.path.join(eddy_config_dir(outdir), 'eddy_params_s2v_mbs.json')
+
 
 class Task(tasks.BaseTask):
-	def __init__(self, sub, ses, run, bids, outdir, qsiprep_config, fs_license, slurm_job_id, truncate_fmap=False, container_dir=None, custom_eddy_qsiprep=False, no_gpu=False, output_resolution=None, tempdir=None, pipenv=None):
+	def __init__(self, sub, ses, run, bids, outdir, qsiprep_config, fs_license, slurm_job_id, truncate_fmap=False, index=None, cache=None, container_dir=None, custom_eddy_qsiprep=False, no_gpu=False, output_resolution=None, scratch=None, tempdir=None, pipenv=None):
 		self._sub = sub
 		self._ses = ses
 		self._run = run
@@ -38,8 +63,18 @@ class Task(tasks.BaseTask):
 		self._container_dir = container_dir
 		self._custom_eddy = custom_eddy_qsiprep
 		self._no_gpu = no_gpu
-		self._layout = BIDSLayout(bids)
+		self._index = index if index else Index(bids, sub=sub, ses=ses)
+		self._layout = self._index.layout
 		self._output_resolution = output_resolution
+		self._cache = cache
+		self._scratch = scratch
+		self.cache_key = None
+		self.cached = False
+		# custom eddy parameters are a file supplied by the user
+		if custom_eddy_qsiprep:
+			self._eddy_params = os.path.abspath(custom_eddy_qsiprep)
+		else:
+			self._eddy_params = eddy_params(outdir)
 		super().__init__(outdir, tempdir, pipenv)
 
 
@@ -93,7 +128,7 @@ class Task(tasks.BaseTask):
 			try:
 				t1_file = self._layout.get(subject=self._sub, session=self._ses, suffix='T1w', extension='.nii.gz', return_type='filename').pop()
 
-				self._output_resolution = str(nib.load(t1_file).header['pixdim'][1])
+				self._output_resolution = str(nifti.inspect(t1_file).pixdim[0])
 			except IndexError:
 				logger.info('no t1 file provded, defaulting to resolution of 1.0')
 				self._output_resolution = '1.0'
@@ -171,7 +206,8 @@ class Task(tasks.BaseTask):
 		slspec = [sindx[i:i + mb] for i in range(0, len(sindx), mb)]
 		slspec = [[item - 0 for item in sublist] for sublist in slspec]
 
-		spec_file = f"{self._bids}/even_slices_slspec.txt"
+		spec_file = slspec(self._outdir)
+		logger.info('writing slspec for an even number of slices to %s', spec_file)
 
 		with open(spec_file, 'w') as fp:
 			for sublist in slspec:
@@ -219,7 +255,8 @@ class Task(tasks.BaseTask):
 
 		all_cols = np.column_stack([col1, col2, col3])
 
-		spec_file = f"{self._bids}/odd_slices_slspec.txt"
+		spec_file = slspec(self._outdir)
+		logger.info('writing slspec for an odd number of slices to %s', spec_file)
 
 		np.savetxt(spec_file, all_cols, fmt=['%d', '%d', '%d'])
 
@@ -228,6 +265,7 @@ class Task(tasks.BaseTask):
 	# create necessary fsl eddy parameters json file using output from create_spec and calc_mporder
 
 	def create_eddy_params(self):
+		os.makedirs(eddy_config_dir(self._outdir), exist_ok=True)
 		mporder = self.calc_mporder()
 		self.create_spec()
 		params_file = {
@@ -255,7 +293,7 @@ class Task(tasks.BaseTask):
 		}
 		
 		if not self._custom_eddy:
-			with open(f"{self._bids}/eddy_params_s2v_mbs.json", "w") as f:
+			with open(self._eddy_params, "w") as f:
 				json.dump(params_file, f)
 		else:
 			print('Custom eddy_params file being fed in by user.')
@@ -368,14 +406,15 @@ class Task(tasks.BaseTask):
 		"""
 		if self._truncate_fmap:
 
-			layout = BIDSLayout(self._bids)
+			# pick up the fieldmaps created by check_fieldmaps
+			self._layout = self._index.refresh(sub=self._sub)
 
-			fmap_files = layout.get(subject=self._sub, session=self._ses, suffix='epi', extension='.nii.gz', return_type='filename')
+			fmap_files = self._layout.get(subject=self._sub, session=self._ses, suffix='epi', extension='.nii.gz', return_type='filename')
 
 			logger.info(f'running truncation on {fmap_files}')
 
 			for fmap in fmap_files:
-				shape = nib.load(fmap).get_fdata().shape
+				shape = nifti.inspect(fmap).shape
 				if len(shape) == 4:
 					num_vols = shape[3]
 					logger.info(f'{fmap} has {num_vols} volumes')
@@ -387,6 +426,12 @@ class Task(tasks.BaseTask):
 
 	def run_fslroi(self, fmap, volume):
 		vol_index = int(volume) - 1
+		try:
+			nifti.select_volumes(fmap, fmap, [vol_index])
+			logger.info(f'selected volume {vol_index} of {fmap}')
+			return
+		except nifti.ERRORS as e:
+			logger.warning(f'native volume selection failed for {fmap}, falling back to fslroi: {e}')
 		split_command = f'singularity exec {self._fsl_sif} /APPS/fsl/bin/fslroi {fmap} {fmap} {str(vol_index)} 1'
 		logger.info(f'executing {split_command}')
 		proc1 = subprocess.check_output(split_command, shell=True, stderr=subprocess.STDOUT, text=True)
@@ -424,6 +469,13 @@ class Task(tasks.BaseTask):
 
 		os.makedirs(self._outdir, exist_ok=True)
 
+		try:
+			nifti.select_volumes(dwi_full_path, epi_out_path, b0_volumes)
+			logger.info(f'selected volumes {b0_string} of {dwi_full_path} into "{epi_out_path}"')
+			return epi_out_path
+		except nifti.ERRORS as e:
+			logger.warning(f'native volume selection failed for {dwi_full_path}, falling back to fslselectvols: {e}')
+
 		try:
 			extract_command = f'singularity exec {self._fsl_sif} /APPS/fsl/bin/fslselectvols -i {dwi_full_path} -o {epi_out_path} --vols={b0_string}'
 			logger.info(f'executing {extract_command}')
@@ -528,21 +580,65 @@ class Task(tasks.BaseTask):
 			return None
 
 	def delete_bval_bvec(self):
-		cwd = os.getcwd()
 		logging.info('cleaning fmap bids directory')
 		fmap_dir = os.path.join(f'{self._bids}/sub-{self._sub}/ses-{self._ses}/fmap')
-		os.chdir(fmap_dir)
-		for file in os.listdir():
+		for file in os.listdir(fmap_dir):
 			if file.endswith('.bval') or file.endswith('.bvec'):
-				os.remove(file)
-		os.chdir(cwd)
+				os.remove(os.path.join(fmap_dir, file))
 
 	def bind_environmentals(self):
 	
-		bind = [self._bids, self._tempdir, self._fs_license]
+		bind = [self._bids, self._tempdir, self._fs_license, os.path.dirname(self._eddy_params)]
 		
 		os.environ["SINGULARITY_BIND"] = ','.join(bind)
 
+	# restore the outputs from the result cache if these inputs were processed before
+
+	def check_cache(self, qsiprep_options):
+		session = os.path.join(self._bids, f'sub-{self._sub}', f'ses-{self._ses}')
+		inputs = {
+			'eddy_params_s2v_mbs.json': self._eddy_params,
+			os.path.basename(self._spec): self._spec
+		}
+		for root, dirs, files in os.walk(session):
+			for name in files:
+				path = os.path.join(root, name)
+				inputs[os.path.relpath(path, self._bids)] = path
+		self.cache_key = self._cache.key(
+			self._qsiprep_sif,
+			inputs,
+			task='qsiprep',
+			sub=self._sub,
+			ses=self._ses,
+			output_resolution=self._output_resolution,
+			options=qsiprep_options,
+			# entries include the eddy_quad results added by post-processing
+			contents='eddy_quad'
+		)
+		if self._cache.restore(self.cache_key, self._outdir):
+			self.cached = True
+			with open(self._prov, 'w') as fo:
+				json.dump(self._cache.provenance(self.cache_key), fo, indent=2)
+		# track after restoring, a miss unshares outdir from the previously tracked entry
+		cache.track(self._outdir, self.cache_key)
+
+	# run qsiprep against node-local scratch with only this session of the BIDS directory,
+	# staging back the outputs and the work files eddy_quad needs
+
+	def use_scratch(self):
+		plan = Plan(self._scratch)
+		plan.add(self._bids, 'bids', stage_out=False, filters=[
+			f'+ /sub-{self._sub}/',
+			f'+ /sub-{self._sub}/ses-{self._ses}/***',
+			f'- /sub-{self._sub}/*/',
+			'- /*/'
+		])
+		plan.add(self._outdir, 'outputs', filters=['- /logs/'])
+		plan.add(self._workdir, 'work', stage_in=False, filters=EDDY_ARTIFACTS)
+		start = self._command.index('singularity')
+		planfile = os.path.join(self.logdir(), 'dwiqc-qsiprep-scratch.json')
+		self._command = self._command[:start] + plan.wrap(self._command[start:], planfile)
+
 	# create qsiprep command to be executed
 
 	def build(self):
@@ -560,6 +656,7 @@ class Task(tasks.BaseTask):
 			print("There's an issue with the prequal config file.\nMake sure it is a .yaml file with proper formatting.")
 			sys.exit()
 		qsiprep_options = qsiprep_command['qsiprep']['shell']
+		self._workdir = f"{self._tempdir}/qsiprep_{date}/{self._slurm_job_id}/{self._ses}"
 		
 		self._command = [
 			'selfie',
@@ -575,16 +672,23 @@ class Task(tasks.BaseTask):
 			'--output-resolution',
 			self._output_resolution,
 			'--eddy-config',
-			f'{self._bids}/eddy_params_s2v_mbs.json',
+			self._eddy_params,
 			'--fs-license-file',
 			self._fs_license,
 			'-w',
-			f"{self._tempdir}/qsiprep_{date}/{self._slurm_job_id}/{self._ses}"
+			self._workdir
 		]
 
 		for item in qsiprep_options:
 			self._command.append(item)
 
+		if self._cache:
+			self.logdir()
+			self.check_cache(qsiprep_options)
+
+		if self._scratch:
+			self.use_scratch()
+
 		if self._no_gpu:
 			logdir = self.logdir()
 			logfile = os.path.join(logdir, 'dwiqc-qsiprep.log')
@@ -3,26 +3,30 @@ import os
 import sys
 import re
 import dwiqc.tasks as tasks
+import dwiqc.nifti as nifti
 import logging
 import subprocess
 import json
 from executors.models import Job
 from datetime import datetime
 from pathlib import Path
-import nibabel as nib
 import numpy as np
 
 date = datetime.today().strftime('%Y-%m-%d')
 
 
 class Task(tasks.BaseTask):
-	def __init__(self, sub, ses, run, bids, outdir, slurm_job_id, container_dir=None, parent=None, tempdir=None, pipenv=None):
+	def __init__(self, sub, ses, run, bids, outdir, slurm_job_id, container_dir=None, parent=None, work_date=None, spec_file=None, tempdir=None, pipenv=None):
 		self._sub = sub
 		self._ses = ses
 		self._run = run
 		self._bids = bids
 		self._slurm_job_id = slurm_job_id
 		self._container_dir = container_dir
+		# date the qsiprep work directory was named with when the job was submitted
+		self._date = work_date if work_date else date
+		# slspec written for this session by the qsiprep task
+		self._spec_file = spec_file
 		super().__init__(outdir, tempdir, pipenv)
 
 
@@ -47,9 +51,9 @@ class Task(tasks.BaseTask):
 
 		# Define working directory for the subject
 
-		dwi_preproc_string = self.match_preproc_string(f"{self._tempdir}/qsiprep_{date}/{self._slurm_job_id}/{self._ses}/qsiprep_wf/single_subject_{self._sub}_wf")
+		dwi_preproc_string = self.match_preproc_string(f"{self._tempdir}/qsiprep_{self._date}/{self._slurm_job_id}/{self._ses}/qsiprep_wf/single_subject_{self._sub}_wf")
 
-		qsiprep_work_dir = f"{self._tempdir}/qsiprep_{date}/{self._slurm_job_id}/{self._ses}/qsiprep_wf/single_subject_{self._sub}_wf/{dwi_preproc_string}/hmc_sdc_wf"
+		qsiprep_work_dir = f"{self._tempdir}/qsiprep_{self._date}/{self._slurm_job_id}/{self._ses}/qsiprep_wf/single_subject_{self._sub}_wf/{dwi_preproc_string}/hmc_sdc_wf"
 
 		# Define eddy quad destination directory
 
@@ -89,20 +93,19 @@ class Task(tasks.BaseTask):
 
 		self.rename_file(f'{eddy_quad_dir}/{full_bval_name}', f'{eddy_quad_dir}/{self._sub}.bval')
 
-		# copy slspec file from bids dir
+		# fall back to a slspec file in the bids dir
 
-		for file in os.listdir(self._bids):
-			if 'slspec' in file and file.endswith('.txt'):
-				self._spec_file = f'{self._bids}/{file}'
+		if not self._spec_file:
+			for file in os.listdir(self._bids):
+				if 'slspec' in file and file.endswith('.txt'):
+					self._spec_file = f'{self._bids}/{file}'
 
 		# rename all the files in eddy_quad_dir that start with "eddy_results"
 
-		os.chdir(eddy_quad_dir)
-
-		for file in os.listdir():
+		for file in os.listdir(eddy_quad_dir):
 			if file.startswith("eddy_corrected"):
 				new_name = file.replace("eddy_corrected", f"{self._sub}_{self._ses}")
-				self.rename_file(file, new_name)
+				self.rename_file(f'{eddy_quad_dir}/{file}', f'{eddy_quad_dir}/{new_name}')
 
 		# run eddy_quad on output
 
@@ -148,12 +151,14 @@ class Task(tasks.BaseTask):
 		-v
 		"""
 
-		if os.path.isdir(f'{self._sub}_{self._ses}.qc'):
+		qc_dir = f'{eddy_quad_dir}/{self._sub}_{self._ses}.qc'
+
+		if os.path.isdir(qc_dir):
 			logging.warning('Output directory already exists. Removing and trying again.')
-			shutil.rmtree(f'{self._sub}_{self._ses}.qc')
+			shutil.rmtree(qc_dir)
 
 		logging.info('Running eddy_quad...')
-		proc1 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+		proc1 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, cwd=eddy_quad_dir)
 		proc1.communicate()
 		code = proc1.returncode
 
@@ -171,7 +176,7 @@ class Task(tasks.BaseTask):
 			self.verify_bval_bvec_match(eddy_quad_dir)
 
 			logging.info('Running eddy_quad for the 2nd time...')
-			proc1 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+			proc1 = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, cwd=eddy_quad_dir)
 			proc1.communicate()
 			code = proc1.returncode
 
@@ -223,7 +228,7 @@ class Task(tasks.BaseTask):
 		nii_file_path = Path(eddy_quad_dir, f'{self._sub}_{self._ses}.nii.gz')
 
 		bvals = np.genfromtxt(bval_file_path, dtype=float)
-		nii_file = nib.load(nii_file_path)
+		nii_file = nifti.inspect(nii_file_path)
 
 		if nii_file.shape[3] != np.max(bvals.shape):
 			new_bvals = self.adjust_bvals_shape_nii(bvals, nii_file)
@@ -310,7 +315,7 @@ class Task(tasks.BaseTask):
 		## Write out all these values to json file
 
 
-		with open('eddy_metrics.json', 'w') as outfile:
+		with open(os.path.join(os.path.dirname(eddy_dir), 'eddy_metrics.json'), 'w') as outfile:
 			json.dump(metrics_dict, outfile, indent=1)
 
 		logging.info('successfully parsed json and wrote out results to eddy_metrics.json')
@@ -0,0 +1,263 @@
+import os
+import json
+import hashlib
+import zipfile
+import tempfile
+import yaxil
+import logging
+import requests
+from lxml import etree
+from dwiqc.checkpoint import digest
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+logger = logging.getLogger(__name__)
+
+# concurrent resource file uploads
+UPLOAD_WORKERS = 4
+
+# attempts per file before an upload is reported as failed
+UPLOAD_ATTEMPTS = 3
+
+# journal of completed uploads, saved next to the assessor and resources
+JOURNAL = 'upload-journal.json'
+
+# suffixes that are already compressed and are stored in bundles as is
+STORED_SUFFIXES = ('.png', '.gif', '.jpg', '.pdf', '.gz', '.zip')
+
+class UploadError(Exception):
+    pass
+
+class RetryableUploadError(UploadError):
+    pass
+
+class Uploader:
+    '''
+    Upload an assessor and its resources to XNAT over the REST API.
+
+    The assessment XML is posted first, then resource files are uploaded
+    concurrently over one pooled HTTP session, largest first. The assessment
+    and every file that is stored are recorded in a local journal by their
+    checksum, so a later upload of the same artifacts only sends what is
+    missing from XNAT or has changed since. Files are sent with overwrite
+    set and are only journaled once XNAT reports them stored.
+
+    With bundle set to 'resource' each resource folder is zipped and
+    uploaded as one file, with 'all' the whole resources tree is. Bundles
+    are extracted by XNAT on upload and journaled like single files.
+    '''
+    def __init__(self, auth, artifacts_dir, resource_name, workers=UPLOAD_WORKERS, bundle=None):
+        self.auth = auth
+        self.artifacts_dir = artifacts_dir
+        self.resource_name = resource_name
+        self.workers = workers
+        self.bundle = bundle
+        self.assessment = os.path.join(artifacts_dir, 'assessor', 'assessment.xml')
+        self.resources = os.path.join(artifacts_dir, 'resources')
+        self.journal_file = os.path.join(artifacts_dir, JOURNAL)
+        self.baseurl = auth.url.rstrip('/')
+
+    def upload(self):
+        with open(self.assessment) as fo:
+            root = etree.parse(fo)
+        aid = root.getroot().attrib['ID']
+        sid = root.findall('.//{http://nrg.wustl.edu/xnat}imageSession_ID').pop().text
+        self.base = f'{self.baseurl}/data/experiments/{sid}/assessors'
+        self.aid = aid
+        journal = self.load_journal(aid)
+
+        with yaxil.session(self.auth), requests.Session() as session:
+            session.auth = yaxil.basicauth(self.auth)
+            session.cookies.update(self.auth.cookie)
+            session.verify = yaxil.CHECK_CERTIFICATE
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.session = session
+
+            assessment_stamp = stamp(('assessor/assessment.xml', self.assessment))
+            if journal['assessment'] != assessment_stamp:
+                self.post_assessment()
+                journal['assessment'] = assessment_stamp
+                self.save_journal(journal)
+            if not journal['resource']:
+                self.put_resource_folder()
+                journal['resource'] = True
+                self.save_journal(journal)
+
+            pending = list()
+            for name,files in self.units():
+                unit_stamp = stamp(*files)
+                if journal['files'].get(name) == unit_stamp:
+                    logger.debug('skipping %s, already uploaded', name)
+                    continue
+                pending.append((name, files, unit_stamp))
+            logger.info('uploading %s resource files or bundles for %s', len(pending), aid)
+
+            errors = list()
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(self.put_unit, name, files): (name, unit_stamp) for name,files,unit_stamp in pending}
+                for future in as_completed(futures):
+                    name,unit_stamp = futures[future]
+                    try:
+                        future.result()
+                    except (UploadError, requests.RequestException, OSError) as e:
+                        errors.append((name, e))
+                        continue
+                    journal['files'][name] = unit_stamp
+                    self.save_journal(journal)
+
+        if errors:
+            for name,e in errors:
+                logger.error('failed to upload %s after %s attempts: %s', name, UPLOAD_ATTEMPTS, e)
+            raise UploadError(f'{len(errors)}/{len(pending)} resource uploads failed to upload, re-run to upload only those')
+
+    def files(self):
+        '''
+        Resource files as (resource/file, full path), largest first so they
+        do not end up at the tail of the upload
+        '''
+        files = list()
+        for resource in sorted(os.listdir(self.resources)):
+            resource_dir = os.path.join(self.resources, resource)
+            for f in sorted(os.listdir(resource_dir)):
+                files.append((f'{resource}/{f}', os.path.join(resource_dir, f)))
+        return sorted(files, key=lambda x: os.path.getsize(x[1]), reverse=True)
+
+    def units(self):
+        '''
+        What gets uploaded as (name, [(resource/file, full path), ...]),
+        a single file or a zip bundle of files per unit
+        '''
+        files = self.files()
+        if self.bundle == 'all':
+            return [('resources.zip', files)]
+        if self.bundle == 'resource':
+            bundles = dict()
+            for relpath,fullfile in files:
+                resource = relpath.split('/')[0]
+                bundles.setdefault(f'{resource}.zip', list()).append((relpath, fullfile))
+            return sorted(bundles.items(), key=lambda x: sum(os.path.getsize(f) for _,f in x[1]), reverse=True)
+        return [(relpath, [(relpath, fullfile)]) for relpath,fullfile in files]
+
+    def put_unit(self, name, files):
+        if not self.bundle:
+            relpath,fullfile = files[0]
+            self.put_file_with_retry(relpath, fullfile)
+            return
+        with tempfile.TemporaryDirectory() as tmpdir:
+            archive = os.path.join(tmpdir, name)
+            with zipfile.ZipFile(archive, 'w') as zf:
+                for relpath,fullfile in files:
+                    compression = zipfile.ZIP_STORED if fullfile.endswith(STORED_SUFFIXES) else zipfile.ZIP_DEFLATED
+                    zf.write(fullfile, relpath, compress_type=compression)
+            logger.debug('bundled %s files into %s', len(files), name)
+            self.put_file_with_retry(name, archive, extract=True)
+
+    def post_assessment(self):
+        logger.debug('posting %s to %s', self.assessment, self.base)
+        with open(self.assessment, 'rb') as fo:
+            r = self.session.post(self.base, files={'file': fo}, allow_redirects=True)
+        if r.status_code == requests.codes.ok:
+            logger.debug('assessment %s uploaded successfully', self.aid)
+        elif r.status_code == requests.codes.conflict:
+            logger.debug('assessment %s already exists, updating it', self.aid)
+            self.put_assessment()
+        else:
+            raise UploadError(f'assessment {self.assessment} failed to upload ({r.status_code})')
+
+    def put_assessment(self):
+        '''
+        Replace the fields of an existing assessor with the assessment XML,
+        keeping the resources that were already uploaded to it
+        '''
+        url = f'{self.base}/{self.aid}'
+        params = {
+            'inbody': 'true',
+            'allowDataDeletion': 'false'
+        }
+        logger.debug('PUT %s', url)
+        with open(self.assessment, 'rb') as fo:
+            r = self.session.put(url, params=params, data=fo, headers={'Content-Type': 'text/xml'}, allow_redirects=True)
+        if r.status_code in (requests.codes.ok, requests.codes.created):
+            logger.debug('assessment %s updated successfully', self.aid)
+        else:
+            raise UploadError(f'assessment {self.assessment} failed to update ({r.status_code})')
+
+    def put_resource_folder(self):
+        url = f'{self.base}/{self.aid}/resources/{self.resource_name}'
+        logger.debug('PUT %s', url)
+        r = self.session.put(url, allow_redirects=True)
+        if r.status_code in (requests.codes.ok, requests.codes.created):
+            logger.debug('resource folder created %s', self.resource_name)
+        elif r.status_code == requests.codes.conflict:
+            logger.debug('resource folder %s likely already exists', self.resource_name)
+        else:
+            raise UploadError(f'could not create resource folder {self.resource_name} ({r.status_code})')
+
+    @retry(
+        retry=retry_if_exception_type((RetryableUploadError, requests.ConnectionError, requests.Timeout)),
+        stop=stop_after_attempt(UPLOAD_ATTEMPTS),
+        wait=wait_exponential(multiplier=2, max=30),
+        reraise=True
+    )
+    def put_file_with_retry(self, relpath, fullfile, extract=False):
+        self.put_file(relpath, fullfile, extract=extract)
+
+    def put_file(self, relpath, fullfile, extract=False):
+        '''
+        Store a resource file, replacing any earlier upload of it. Only a
+        200 or 201 counts as stored, anything else is raised so the file is
+        not journaled.
+        '''
+        url = f'{self.base}/{self.aid}/resources/{self.resource_name}/files/{relpath}'
+        params = {'overwrite': 'true'}
+        if extract:
+            params['extract'] = 'true'
+        logger.debug('PUT %s', url)
+        with open(fullfile, 'rb') as fo:
+            r = self.session.put(url, params=params, files={'file': fo}, allow_redirects=True)
+        if r.status_code in (requests.codes.ok, requests.codes.created):
+            logger.debug('file %s was stored successfully', fullfile)
+        elif r.status_code >= 500:
+            raise RetryableUploadError(f'could not store resource file {fullfile} ({r.status_code})')
+        else:
+            raise UploadError(f'could not store resource file {fullfile} ({r.status_code})')
+
+    def load_journal(self, aid):
+        '''
+        Read the journal for this assessor, starting over if the artifacts
+        were rebuilt for a different assessor
+        '''
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file) as fo:
+                journal = json.load(fo)
+            if journal.get('assessor') == aid:
+                return journal
+        return {
+            'assessor': aid,
+            'assessment': False,
+            'resource': False,
+            'files': dict()
+        }
+
+    def save_journal(self, journal):
+        tmp = f'{self.journal_file}.tmp'
+        with open(tmp, 'w') as fo:
+            json.dump(journal, fo, indent=2)
+        os.replace(tmp, self.journal_file)
+
+def stamp(*files):
+    '''
+    Size and checksum of the (resource/file, full path) pairs in an upload,
+    so artifacts that are rebuilt with the same content are not uploaded
+    again
+    '''
+    if len(files) == 1:
+        _,fullfile = files[0]
+        return f'{os.path.getsize(fullfile)}:{digest(fullfile)}'
+    sha = hashlib.sha1()
+    for relpath,fullfile in sorted(files):
+        sha.update(f'{relpath}:{os.path.getsize(fullfile)}:{digest(fullfile)}'.encode('utf-8'))
+    return sha.hexdigest()
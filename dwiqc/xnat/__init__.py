@@ -10,8 +10,10 @@ import shutil
 import zipfile
 import logging
 import numpy as np
+import collections as col
 from lxml import etree
-from bids import BIDSLayout
+from dwiqc.layout import Index
+import dwiqc.files as files
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +21,13 @@ logger = logging.getLogger(__name__)
 
 
 class Report:
-    def __init__(self, bids, sub, ses, run):
+    def __init__(self, bids, sub, ses, run, index=None):
         self.module = os.path.dirname(__file__)
         self.bids = bids
         self.sub = sub
         self.run = run
         self.ses = ses if ses else ''
+        self.index = index if index else Index(bids, sub=sub, ses=ses)
  
     def getdirs(self):
         self.dirs = {
@@ -32,6 +35,9 @@ class Report:
             'qsiprep': None,
         }
 
+        # get bids layout structure, picking up any files added by the tasks
+        self.layout = self.index.refresh(sub=self.sub)
+
         # build path to output directories
         for task in self.dirs.keys():
             dirname = os.path.join(
@@ -42,10 +48,6 @@ class Report:
                 'ses-' + self.ses.replace('ses-', ''),
             )
 
-            # get bids layout structure
-
-            self.layout = BIDSLayout(self.bids)
-
             json_file = self.layout.get(subject=self.sub, session=self.ses, suffix='dwi', extension='.json', return_type='filename').pop()
 
             self.basename = self.strip_extension(json_file)
@@ -60,11 +62,13 @@ class Report:
         logger.debug('qsiprep dir: %s', self.dirs['qsiprep'])
 
 
-    def build_assessment(self, output):
+    def build_assessment(self, output, staging='copy'):
         '''
         Build XNAT assessment
 
         :param output: Base output directory
+        :param staging: How resources are placed in the output directory,
+                        copy, link (hardlink or reflink) or symlink
         '''
         self.getdirs()
         if not self.dirs['prequal'] or not self.dirs['qsiprep']:
@@ -193,31 +197,27 @@ class Report:
 
         resources_dir = os.path.join(output, 'resources')
         os.makedirs(resources_dir, exist_ok=True)
+        staged = col.Counter()
+
+        # classify every figure by suffix in a single pass over the directory
+        figures = files.Inventory(qsiprep_source_dir).by_suffix(file_endings)
 
         for ending, dirname in file_endings.items():
-            matches = []
-            for file in os.listdir(qsiprep_source_dir):
-                if file.endswith(ending):
-                    if file not in matches:
-                        matches.append(file)
-                    else:
-                        continue
+            matches = figures.get(ending, [])
 
             os.makedirs(f'{resources_dir}/{dirname}', exist_ok=True)
 
-            for match in matches:
-                shutil.copy(f'{qsiprep_source_dir}/{match}', f'{resources_dir}/{dirname}/{aid}{ending}')
+            # every match is staged to the same name, only the last one would survive
+            for match in matches[-1:]:
+                staged[self.stage(f'{qsiprep_source_dir}/{match}', f'{resources_dir}/{dirname}/{aid}{ending}', staging)] += 1
 
 
 
         # get all the b-shell values from eddy-quad
         shells = list()
         qcdir = os.path.join(self.dirs['qsiprep'], 'qsiprep_output', 'qsiprep', 'EDDY', f'{no_prefix_sub}_{self.ses}.qc')
-        for filename in os.listdir(qcdir):
+        for filename, match in files.Inventory(qcdir).match(r'avg_b(\d+).png'):
             fullfile = os.path.join(qcdir, filename)
-            match = re.match(r'avg_b(\d+).png', filename)
-            if not match:
-                continue
             shells.append(int(match.group(1)))
             shell_dict = {
                 'source': fullfile,
@@ -285,7 +285,14 @@ class Report:
             src = resource['source']
             dest = os.path.join(resources_dir, resource['dest'])
             os.makedirs(os.path.dirname(dest), exist_ok=True)
-            shutil.copyfile(src, dest)
+            staged[self.stage(src, dest, staging)] += 1
+        logger.info('staged %s resources with %s staging: %s', sum(staged.values()), staging,
+            ', '.join(f'{n} {method}' for method,n in sorted(staged.items())))
+
+    def stage(self, src, dest, staging):
+        method = files.stage(src, dest, mode=staging)
+        logger.debug('staged %s to %s (%s)', src, dest, method)
+        return method
 
 
     def protocol(self, task):
@@ -54,6 +54,16 @@ def main():
         help='Tell yaxil to download data in memory. This can help with download speeds')
     parser_get.add_argument('--dry-run', action='store_true',
         help='Do not execute any jobs')
+    parser_get.add_argument('--download-workers', type=int, default=4,
+        help='Number of scans to download concurrently')
+    parser_get.add_argument('--download-engine', choices=['yaxil', 'arcget'], default='arcget',
+        help='Download in this process with yaxil or by running ArcGet.py')
+    parser_get.add_argument('--incremental', action='store_true',
+        help='Only download scans that are missing or changed since the last download')
+    parser_get.add_argument('--catalogue-dir',
+        help='Look up scans in a cached catalogue of every session in --project, saved to this directory')
+    parser_get.add_argument('--catalogue-expiry', type=int, default=60,
+        help='Minutes before the cached scan catalogue is fetched again')
     parser_get.set_defaults(func=cli.get.do)
 
     # process mode
@@ -98,12 +108,20 @@ def main():
         help='XNAT password')
     parser_process.add_argument('--artifacts-dir',
         help='Location for generated assessors and resources')
+    parser_process.add_argument('--artifacts-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink resources into the artifacts directory')
+    parser_process.add_argument('--inputs-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink NIfTI images into the prequal INPUTS directory')
+    parser_process.add_argument('--scratch-dir',
+        help='Node-local directory prequal and qsiprep jobs stage in to and run from, expanded on the node')
     parser_process.add_argument('--custom-eddy-qsiprep',
         help='Feed in path to customized eddy parameters file for qsiprep.')
     parser_process.add_argument('--custom-eddy-prequal_stdev', default='6',
         help='Feed in path to customized eddy parameters file for prequal.')
     parser_process.add_argument('--xnat-upload', action='store_true',
         help='Upload results to XNAT over REST API')
+    parser_process.add_argument('--upload-bundle', choices=['resource', 'all'], default=None,
+        help='Upload each resource folder, or all resources, as one zip that XNAT extracts')
     parser_process.add_argument('--container-dir',
         help='Pass path to downloaded DWIQC containers')
     parser_process.add_argument('--exclude-nodes', nargs='+',
@@ -112,71 +130,223 @@ def main():
         help='Working directory that is shared across compute cluster')
     parser_process.add_argument('--truncate-qsiprep-fmap', action='store_true',
         help='Truncate the fmap created from the main diffusion scan to just one b0 volume.')
+    parser_process.add_argument('--index-scope', choices=['dataset', 'session'], default='dataset',
+        help='Index the whole BIDS dataset or only the requested subject/session')
+    parser_process.add_argument('--detach', action='store_true',
+        help='Submit post-processing and report jobs that wait on prequal and qsiprep, then exit without waiting')
+    parser_process.add_argument('--resume', action='store_true',
+        help='Skip stages that already completed with unchanged inputs and configuration')
+    parser_process.add_argument('--cache-dir',
+        help='Result cache directory. Unchanged prequal and qsiprep runs are restored from here instead of being re-run')
     parser_process.set_defaults(func=cli.process.do)
 
-    # tandem mode
-    parser_tandem = subparsers.add_parser('tandem', help='tandem -h')
-    parser_tandem.add_argument('--label', required=True,
-        help='XNAT MR Session name')
-    parser_tandem.add_argument('--project',
-        help='XNAT Project name')
-    parser_tandem.add_argument('--download-config', required=True,
+    # batch mode
+    parser_batch = subparsers.add_parser('batch', help='batch -h')
+    parser_batch.add_argument('--partition', required=True,
+        help='Job scheduler partition')
+    parser_batch.add_argument('--scheduler', default=None,
+        help='Choose a specific job scheduler')
+    parser_batch.add_argument('--rate-limit', type=int, default=None, 
+        help='Rate limit the number of tasks executed in parallel (1=serial)')
+    parser_batch.add_argument('--manifest',
+        help='CSV or YAML file listing sub, ses and run to process. Default is every session with diffusion data')
+    parser_batch.add_argument('--bids-dir', required=True,
+        help='BIDS root directory')
+    parser_batch.add_argument('--dry-run', action='store_true',
+        help='Do not execute any jobs')
+    parser_batch.add_argument('--prequal-config', default=config.prequal_command(),
+        help='Config file for custom prequal command.')
+    parser_batch.add_argument('--qsiprep-config', default=config.qsiprep_command(),
+        help='Config file for custom qsiprep command.')
+    parser_batch.add_argument('--no-gpu', action='store_true',
+        help='Run prequal and qsiprep without gpu functionality.')
+    parser_batch.add_argument('--sub-tasks', nargs='+', default=['prequal', 'qsiprep'],
+        help='Run only certain sub tasks')
+    parser_batch.add_argument('--fs-license', required=True,
+        help='Base64 encoded FreeSurfer license file')
+    parser_batch.add_argument('--xnat-alias',
+        help='YAXIL authentication alias')
+    parser_batch.add_argument('--xnat-host',
+        help='XNAT host')
+    parser_batch.add_argument('--xnat-user',
+        help='XNAT username')
+    parser_batch.add_argument('--xnat-pass',
+        help='XNAT password')
+    parser_batch.add_argument('--artifacts-dir',
+        help='Location for generated assessors and resources')
+    parser_batch.add_argument('--artifacts-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink resources into the artifacts directory')
+    parser_batch.add_argument('--inputs-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink NIfTI images into the prequal INPUTS directory')
+    parser_batch.add_argument('--scratch-dir',
+        help='Node-local directory prequal and qsiprep jobs stage in to and run from, expanded on the node')
+    parser_batch.add_argument('--custom-eddy-qsiprep',
+        help='Feed in path to customized eddy parameters file for qsiprep.')
+    parser_batch.add_argument('--custom-eddy-prequal_stdev', default='6',
+        help='Feed in path to customized eddy parameters file for prequal.')
+    parser_batch.add_argument('--xnat-upload', action='store_true',
+        help='Upload results to XNAT over REST API')
+    parser_batch.add_argument('--upload-bundle', choices=['resource', 'all'], default=None,
+        help='Upload each resource folder, or all resources, as one zip that XNAT extracts')
+    parser_batch.add_argument('--container-dir',
+        help='Pass path to downloaded DWIQC containers')
+    parser_batch.add_argument('--exclude-nodes', nargs='+',
+        help='List of cluster nodes to exclude from use.')
+    parser_batch.add_argument('--work-dir',
+        help='Working directory that is shared across compute cluster')
+    parser_batch.add_argument('--truncate-qsiprep-fmap', action='store_true',
+        help='Truncate the fmap created from the main diffusion scan to just one b0 volume.')
+    parser_batch.add_argument('--index-scope', choices=['dataset', 'session'], default='session',
+        help='Index the whole BIDS dataset or only each requested subject/session')
+    parser_batch.add_argument('--detach', action='store_true',
+        help='Submit post-processing and report jobs that wait on prequal and qsiprep, then exit without waiting')
+    parser_batch.add_argument('--resume', action='store_true',
+        help='Skip stages that already completed with unchanged inputs and configuration')
+    parser_batch.add_argument('--cache-dir',
+        help='Result cache directory. Unchanged prequal and qsiprep runs are restored from here instead of being re-run')
+    parser_batch.set_defaults(func=cli.batch.do)
+
+    # postprocess mode, executed by the jobs that process --detach submits
+    parser_postprocess = subparsers.add_parser('postprocess', help='postprocess -h')
+    parser_postprocess.add_argument('--stage', required=True, choices=['prequal', 'qsiprep', 'report'],
+        help='Post-processing stage to run')
+    parser_postprocess.add_argument('--sub', required=True,
+        help='BIDS subject')
+    parser_postprocess.add_argument('--ses', required=True,
+        help='BIDS session')
+    parser_postprocess.add_argument('--run', default=1, type=int,
+        help='BIDS run')
+    parser_postprocess.add_argument('--bids-dir', required=True,
+        help='BIDS root directory')
+    parser_postprocess.add_argument('--slurm-job-id', required=True,
+        help='Job id of the submitting dwiQC process')
+    parser_postprocess.add_argument('--sub-tasks', nargs='+', default=['prequal', 'qsiprep'],
+        help='Sub tasks that were run')
+    parser_postprocess.add_argument('--container-dir',
+        help='Pass path to downloaded DWIQC containers')
+    parser_postprocess.add_argument('--work-dir',
+        help='Working directory that is shared across compute cluster')
+    parser_postprocess.add_argument('--artifacts-dir', required=True,
+        help='Location for generated assessors and resources')
+    parser_postprocess.add_argument('--artifacts-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink resources into the artifacts directory')
+    parser_postprocess.add_argument('--xnat-upload', action='store_true',
+        help='Upload results to XNAT over REST API')
+    parser_postprocess.add_argument('--upload-bundle', choices=['resource', 'all'], default=None,
+        help='Upload each resource folder, or all resources, as one zip that XNAT extracts')
+    parser_postprocess.add_argument('--xnat-alias',
+        help='YAXIL authentication alias')
+    parser_postprocess.add_argument('--index-scope', choices=['dataset', 'session'], default='dataset',
+        help='Index the whole BIDS dataset or only the requested subject/session')
+    parser_postprocess.add_argument('--cache-dir',
+        help='Result cache directory. Unchanged prequal and qsiprep runs are restored from here instead of being re-run')
+    parser_postprocess.add_argument('--qsiprep-date',
+        help='Date in the name of the qsiprep work directory, set when the job is submitted')
+    parser_postprocess.set_defaults(func=cli.postprocess.do)
+
+    # options shared by tandem and sweep mode
+    tandem_args = ap.ArgumentParser(add_help=False)
+    tandem_args.add_argument('--download-config', required=True,
         help='dwiqc XNAT configuration file')
-    parser_tandem.add_argument('--bids-dir', required=True,
+    tandem_args.add_argument('--bids-dir', required=True,
         help='Output BIDS directory')
-    parser_tandem.add_argument('--run', default=1, type=int,
+    tandem_args.add_argument('--run', default=1, type=int,
         help='BIDS run')
     parser_process.add_argument('--output-resolution',
         help='Resolution of output data. Default is resolution of input data.')
-    parser_tandem.add_argument('--partition', required=True,
+    tandem_args.add_argument('--partition', required=True,
         help='Job scheduler partition')
-    parser_tandem.add_argument('--scheduler', default=None,
+    tandem_args.add_argument('--scheduler', default=None,
         help='Choose a specific job scheduler')
-    parser_tandem.add_argument('--rate-limit', type=int, default=None, 
+    tandem_args.add_argument('--rate-limit', type=int, default=None, 
         help='Rate limit the number of tasks executed in parallel (1=serial)')
-    parser_tandem.add_argument('--dry-run', action='store_true',
+    tandem_args.add_argument('--dry-run', action='store_true',
         help='Do not execute any jobs')
-    parser_tandem.add_argument('--prequal-config', default=config.prequal_command(),
+    tandem_args.add_argument('--prequal-config', default=config.prequal_command(),
         help='Config file for custom prequal command.')
-    parser_tandem.add_argument('--qsiprep-config', default=config.qsiprep_command(),
+    tandem_args.add_argument('--qsiprep-config', default=config.qsiprep_command(),
         help='Config file for custom qsiprep command.')
-    parser_tandem.add_argument('--no-gpu', action='store_true',
+    tandem_args.add_argument('--no-gpu', action='store_true',
         help='Run prequal and qsiprep without gpu functionality.')
-    parser_tandem.add_argument('--sub-tasks', nargs='+', default=['prequal', 'qsiprep'],
+    tandem_args.add_argument('--sub-tasks', nargs='+', default=['prequal', 'qsiprep'],
         help='Run only certain sub tasks')
-    parser_tandem.add_argument('--fs-license', required=True,
+    tandem_args.add_argument('--fs-license', required=True,
         help='Base64 encoded FreeSurfer license')
-    parser_tandem.add_argument('--xnat-alias',
+    tandem_args.add_argument('--xnat-alias',
         help='YAXIL authentication alias')
-    parser_tandem.add_argument('--xnat-host',
+    tandem_args.add_argument('--xnat-host',
         help='XNAT host')
-    parser_tandem.add_argument('--xnat-user',
+    tandem_args.add_argument('--xnat-user',
         help='XNAT username')
-    parser_tandem.add_argument('--xnat-pass',
+    tandem_args.add_argument('--xnat-pass',
         help='XNAT password')
-    parser_tandem.add_argument('--tagger-config', default=tagger_config.default(),
+    tandem_args.add_argument('--tagger-config', default=tagger_config.default(),
         help='Path to xnattagger config file')
-    parser_tandem.add_argument('--run-tagger', action='store_true', default=False,
+    tandem_args.add_argument('--run-tagger', action='store_true', default=False,
         help='Run xnattagger')
-    parser_tandem.add_argument('--artifacts-dir',
+    tandem_args.add_argument('--artifacts-dir',
         help='Location for generated assessors and resources')
-    parser_tandem.add_argument('--custom-eddy-qsiprep',
+    tandem_args.add_argument('--artifacts-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink resources into the artifacts directory')
+    tandem_args.add_argument('--inputs-staging', choices=['copy', 'link', 'symlink'], default='copy',
+        help='Copy, hardlink/reflink or symlink NIfTI images into the prequal INPUTS directory')
+    tandem_args.add_argument('--scratch-dir',
+        help='Node-local directory prequal and qsiprep jobs stage in to and run from, expanded on the node')
+    tandem_args.add_argument('--custom-eddy-qsiprep',
         help='Feed in path to customized eddy parameters file for qsiprep.')
-    parser_tandem.add_argument('--custom-eddy-prequal_stdev', default='6',
+    tandem_args.add_argument('--custom-eddy-prequal_stdev', default='6',
         help='Feed in path to customized eddy parameters file for prequal.')
-    parser_tandem.add_argument('--xnat-upload', action='store_true',
+    tandem_args.add_argument('--xnat-upload', action='store_true',
         help='Upload results to XNAT over REST API')
-    parser_tandem.add_argument('--container-dir',
+    tandem_args.add_argument('--upload-bundle', choices=['resource', 'all'], default=None,
+        help='Upload each resource folder, or all resources, as one zip that XNAT extracts')
+    tandem_args.add_argument('--container-dir',
         help='Pass path to downloaded DWIQC containers')
-    parser_tandem.add_argument('--exclude-nodes', nargs='+',
+    tandem_args.add_argument('--exclude-nodes', nargs='+',
         help='List of cluster nodes to exclude from use.')
-    parser_tandem.add_argument('--work-dir',
+    tandem_args.add_argument('--work-dir',
         help='Working directory that is shared across compute cluster')
-    parser_tandem.add_argument('--in-mem', action='store_true', default=False,
+    tandem_args.add_argument('--in-mem', action='store_true', default=False,
         help='Tell yaxil to download data in memory. This can help with download speeds')
-    parser_tandem.add_argument('--truncate-qsiprep-fmap', action='store_true',
+    tandem_args.add_argument('--truncate-qsiprep-fmap', action='store_true',
         help='Truncate the fmap created from the main diffusion scan to just one b0 volume.')
+    tandem_args.add_argument('--index-scope', choices=['dataset', 'session'], default='dataset',
+        help='Index the whole BIDS dataset or only the requested subject/session')
+    tandem_args.add_argument('--detach', action='store_true',
+        help='Submit post-processing and report jobs that wait on prequal and qsiprep, then exit without waiting')
+    tandem_args.add_argument('--resume', action='store_true',
+        help='Skip stages that already completed with unchanged inputs and configuration')
+    tandem_args.add_argument('--cache-dir',
+        help='Result cache directory. Unchanged prequal and qsiprep runs are restored from here instead of being re-run')
+    tandem_args.add_argument('--download-workers', type=int, default=4,
+        help='Number of scans to download concurrently')
+    tandem_args.add_argument('--download-engine', choices=['yaxil', 'arcget'], default='arcget',
+        help='Download in this process with yaxil or by running ArcGet.py')
+    tandem_args.add_argument('--incremental', action='store_true',
+        help='Only download scans that are missing or changed since the last download')
+    tandem_args.add_argument('--catalogue-dir',
+        help='Look up scans in a cached catalogue of every session in --project, saved to this directory')
+    tandem_args.add_argument('--catalogue-expiry', type=int, default=60,
+        help='Minutes before the cached scan catalogue is fetched again')
+    # tandem mode
+    parser_tandem = subparsers.add_parser('tandem', parents=[tandem_args], help='tandem -h')
+    parser_tandem.add_argument('--label', required=True,
+        help='XNAT MR Session name')
+    parser_tandem.add_argument('--project',
+        help='XNAT Project name')
     parser_tandem.set_defaults(func=cli.tandem.do)
+
+    # sweep mode
+    parser_sweep = subparsers.add_parser('sweep', parents=[tandem_args], help='sweep -h')
+    parser_sweep.add_argument('--project', required=True,
+        help='XNAT Project name')
+    parser_sweep.add_argument('--max-downloads', type=int, default=2,
+        help='Number of sessions to download concurrently')
+    parser_sweep.add_argument('--max-sessions', type=int, default=4,
+        help='Number of sessions to process concurrently')
+    parser_sweep.add_argument('--limit', type=int, default=None,
+        help='Queue at most this many sessions')
+    parser_sweep.set_defaults(func=cli.sweep.do)
     args = parser.parse_args()
 
 
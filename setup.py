@@ -5,6 +5,7 @@ here = os.path.abspath(os.path.dirname(__file__))
 
 requires = [
     'yaxil',
+    'requests',
     'pyaml',
     'xnattagger>=0.9.0',
     'PyBIDS',
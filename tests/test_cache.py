@@ -0,0 +1,59 @@
+import os
+import stat
+import pytest
+from dwiqc.cache import ResultCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResultCache(tmp_path / 'cache')
+
+@pytest.fixture
+def container(tmp_path):
+    sif = tmp_path / 'qsiprep.sif'
+    sif.write_bytes(b'image')
+    return str(sif)
+
+@pytest.fixture
+def inputs(tmp_path):
+    inputs = dict()
+    for name,content in [('dwi.nii.gz', b'dwi'), ('dwi.bval', b'0 1000')]:
+        f = tmp_path / name
+        f.write_bytes(content)
+        inputs[name] = str(f)
+    return inputs
+
+def test_key_is_stable(cache, container, inputs):
+    assert cache.key(container, inputs, gpu=True) == cache.key(container, dict(reversed(inputs.items())), gpu=True)
+
+def test_key_changes_with_input_content(cache, container, inputs):
+    key = cache.key(container, inputs)
+    with open(inputs['dwi.bval'], 'w') as fo:
+        fo.write('0 2000')
+    assert cache.key(container, inputs) != key
+
+def test_key_changes_with_input_name(cache, container, inputs):
+    key = cache.key(container, inputs)
+    inputs['sub-01_dwi.bval'] = inputs.pop('dwi.bval')
+    assert cache.key(container, inputs) != key
+
+def test_key_changes_with_params(cache, container, inputs):
+    assert cache.key(container, inputs, gpu=True) != cache.key(container, inputs, gpu=False)
+
+def test_key_changes_with_container(cache, container, inputs):
+    key = cache.key(container, inputs)
+    with open(container, 'wb') as fo:
+        fo.write(b'another image')
+    assert cache.key(container, inputs) != key
+
+def test_stored_entry_is_read_only_copy(cache, tmp_path):
+    outdir = tmp_path / 'out'
+    (outdir / 'logs').mkdir(parents=True)
+    (outdir / 'dwi.nii.gz').write_bytes(b'dwi')
+    (outdir / 'dwi.json').write_text('{}')
+    cache.store('abcd', str(outdir))
+    entry = cache.path('abcd')
+    for name in ('dwi.nii.gz', 'dwi.json'):
+        cached = os.path.join(entry, name)
+        assert not os.path.samefile(cached, outdir / name)
+        assert not os.stat(cached).st_mode & stat.S_IWUSR
+    assert not os.path.exists(os.path.join(entry, 'logs'))
@@ -0,0 +1,109 @@
+import os
+import json
+import argparse
+import pytest
+import dwiqc.checkpoint as checkpoint
+import dwiqc.cli.process as process
+from dwiqc.checkpoint import Checkpoints
+from dwiqc.downloads import Manifest
+
+SUB_TASKS = ['prequal', 'qsiprep']
+
+@pytest.fixture
+def args(tmp_path):
+    bids = tmp_path / 'bids'
+    for dirname in ('dwi', 'anat', 'fmap'):
+        (bids / 'sub-01' / 'ses-01' / dirname).mkdir(parents=True)
+    (bids / 'sub-01' / 'ses-01' / 'dwi' / 'sub-01_ses-01_run-1_dwi.nii.gz').write_bytes(b'dwi')
+    (bids / 'sub-01' / 'ses-01' / 'anat' / 'sub-01_ses-01_run-1_T1w.nii.gz').write_bytes(b't1w')
+    for name in ('prequal.yaml', 'qsiprep.yaml'):
+        (tmp_path / name).write_text('{}')
+    return argparse.Namespace(
+        bids_dir=str(bids),
+        sub='01',
+        ses='01',
+        sub_tasks=SUB_TASKS,
+        resume=True,
+        container_dir=None,
+        prequal_config=str(tmp_path / 'prequal.yaml'),
+        qsiprep_config=str(tmp_path / 'qsiprep.yaml'),
+        custom_eddy_prequal_stdev=None,
+        custom_eddy_qsiprep=None,
+        truncate_qsiprep_fmap=False,
+        no_gpu=False,
+        artifacts_dir=str(tmp_path / 'artifacts'),
+        xnat_upload=False
+    )
+
+def checkpoints(args):
+    tmp = os.path.dirname(args.bids_dir)
+    return Checkpoints(args, {
+        'prequal': os.path.join(tmp, 'prequal'),
+        'qsiprep': os.path.join(tmp, 'qsiprep')
+    })
+
+def run(args, stages=None):
+    '''
+    Record and complete every stage the way a run with --resume would
+    '''
+    cp = checkpoints(args)
+    for stage in stages or checkpoint.stages(SUB_TASKS):
+        cp.record(stage)
+        with checkpoint.provenance(cp.provenance(stage)):
+            pass
+
+def test_stages():
+    assert checkpoint.stages(['qsiprep']) == ['qsiprep', 'qsiprep-postprocess']
+    assert checkpoint.stages(SUB_TASKS)[-1] == 'report'
+
+def test_nothing_to_skip(args):
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == set()
+
+def test_skip_complete_stages(args):
+    run(args)
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == set(checkpoint.stages(SUB_TASKS))
+
+def test_failed_stage_reruns_downstream(args):
+    run(args)
+    cp = checkpoints(args)
+    with open(cp.provenance('prequal'), 'w') as fo:
+        json.dump({'returncode': 1}, fo)
+    assert cp.skip(checkpoint.stages(SUB_TASKS)) == {'qsiprep', 'qsiprep-postprocess'}
+
+def test_changed_input_reruns_everything(args):
+    run(args)
+    dwi = os.path.join(args.bids_dir, 'sub-01', 'ses-01', 'dwi', 'sub-01_ses-01_run-1_dwi.nii.gz')
+    with open(dwi, 'wb') as fo:
+        fo.write(b'new dwi')
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == set()
+
+def test_changed_config_reruns_that_task(args):
+    run(args)
+    args.custom_eddy_prequal_stdev = 3
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == {'qsiprep', 'qsiprep-postprocess'}
+
+def test_edited_fieldmap_is_unchanged(args):
+    run(args)
+    sidecar = os.path.join(args.bids_dir, 'sub-01', 'ses-01', 'fmap', 'sub-01_ses-01_dir-PA_run-1_epi.json')
+    with open(sidecar, 'w') as fo:
+        json.dump({'IntendedFor': []}, fo)
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == set(checkpoint.stages(SUB_TASKS))
+
+def test_downloaded_fieldmap_reruns_everything(args):
+    run(args)
+    manifest = Manifest(os.path.join(args.bids_dir, 'sub-01', 'ses-01'))
+    manifest.scans['fmap_pa_run-1'] = {
+        'scan': '23',
+        'remote': 'stamp',
+        'files': [os.path.join('fmap', 'sub-01_ses-01_dir-PA_run-1_epi.nii.gz')]
+    }
+    manifest.save()
+    assert checkpoints(args).skip(checkpoint.stages(SUB_TASKS)) == set()
+
+def test_record_only_with_resume(args):
+    run(args)
+    cp = checkpoints(args)
+    args.resume = False
+    process.record(cp, args, set())
+    for stage in checkpoint.stages(SUB_TASKS):
+        assert not os.path.exists(cp.sidecar(stage))
@@ -0,0 +1,85 @@
+import os
+import json
+import pytest
+from dwiqc.downloads import Manifest
+
+@pytest.fixture
+def session_dir(tmp_path):
+    session_dir = tmp_path / 'bids' / 'sub-01' / 'ses-01'
+    session_dir.mkdir(parents=True)
+    return str(session_dir)
+
+def convert(session_dir, bids_subdir, basename, scan):
+    '''
+    Write the files a scan is converted to, with the DataSource that yaxil
+    saves in the sidecar
+    '''
+    os.makedirs(os.path.join(session_dir, bids_subdir), exist_ok=True)
+    stem = os.path.join(session_dir, bids_subdir, basename)
+    with open(f'{stem}.json', 'w') as fo:
+        json.dump({'DataSource': {'application/x-xnat': {'scan': scan}}}, fo)
+    with open(f'{stem}.nii.gz', 'wb') as fo:
+        fo.write(b'image')
+    return stem
+
+@pytest.fixture
+def manifest(session_dir):
+    convert(session_dir, 'dwi', 'sub-01_ses-01_run-1_dwi', '25')
+    convert(session_dir, 'fmap', 'sub-01_ses-01_dir-PA_run-1_epi', '23')
+    manifest = Manifest(session_dir)
+    manifest.record(1, '25', 'dwi_main', 'dwi', 'stamp-25')
+    manifest.record(1, '23', 'fmap_pa', 'fmap', 'stamp-23')
+    manifest.save()
+    return Manifest(session_dir)
+
+DOWNLOADS = [(1, '25', 'dwi_main'), (1, '23', 'fmap_pa')]
+
+REMOTE = {'25': 'stamp-25', '23': 'stamp-23'}
+
+def test_saved_outside_session(session_dir, manifest):
+    assert not manifest.filename.startswith(session_dir)
+    assert os.path.exists(manifest.filename)
+
+def test_records_converted_files(manifest):
+    assert manifest.scans['dwi_main_run-1']['files'] == [
+        os.path.join('dwi', 'sub-01_ses-01_run-1_dwi.json'),
+        os.path.join('dwi', 'sub-01_ses-01_run-1_dwi.nii.gz')
+    ]
+
+def test_nothing_pending(manifest):
+    assert manifest.pending(DOWNLOADS, REMOTE) == []
+
+def test_new_scan_is_pending(manifest):
+    assert manifest.pending(DOWNLOADS + [(1, '3', 't1w')], REMOTE) == [(1, '3', 't1w')]
+
+def test_changed_scan_is_pending_and_discarded(session_dir, manifest):
+    assert manifest.pending([(1, '26', 'dwi_main')], REMOTE) == [(1, '26', 'dwi_main')]
+    assert not os.path.exists(os.path.join(session_dir, 'dwi', 'sub-01_ses-01_run-1_dwi.nii.gz'))
+    assert 'dwi_main_run-1' not in manifest.scans
+
+def test_changed_on_xnat_is_pending(manifest):
+    assert manifest.pending(DOWNLOADS, dict(REMOTE, **{'23': 'new'})) == [(1, '23', 'fmap_pa')]
+
+def test_missing_file_is_pending(session_dir, manifest):
+    os.remove(os.path.join(session_dir, 'dwi', 'sub-01_ses-01_run-1_dwi.json'))
+    assert manifest.pending(DOWNLOADS, REMOTE) == [(1, '25', 'dwi_main')]
+
+def test_edited_fieldmap_is_not_pending(session_dir, manifest):
+    sidecar = os.path.join(session_dir, 'fmap', 'sub-01_ses-01_dir-PA_run-1_epi.json')
+    with open(sidecar) as fo:
+        js = json.load(fo)
+    js['IntendedFor'] = ['ses-01/dwi/sub-01_ses-01_run-1_dwi.nii.gz']
+    with open(sidecar, 'w') as fo:
+        json.dump(js, fo)
+    assert manifest.pending(DOWNLOADS, REMOTE) == []
+
+def test_derived_files_are_not_recorded(session_dir):
+    # a fieldmap the pipeline extracted from the dwi scan
+    convert(session_dir, 'dwi', 'sub-01_ses-01_run-1_dwi', '25')
+    convert(session_dir, 'fmap', 'sub-01_ses-01_dir-AP_run-1_epi', '25')
+    manifest = Manifest(session_dir)
+    manifest.record(1, '25', 'dwi_main', 'dwi')
+    assert all(f.startswith('dwi') for f in manifest.scans['dwi_main_run-1']['files'])
+
+def test_stamps(manifest):
+    assert manifest.stamps('fmap') == {'fmap_pa_run-1': '23:stamp-23'}
@@ -0,0 +1,81 @@
+from executors.models import JobArray
+from dwiqc.pipeline import Parents, Pipeline
+
+class Job:
+    def __init__(self, name, returncode=0):
+        self.name = name
+        self.pid = None
+        self.parent = None
+        self.returncode = None
+        self._returncode = returncode
+
+class Executor:
+    '''
+    Runs every job as soon as it is submitted and finishes it on the next
+    update
+    '''
+    def __init__(self):
+        self.submitted = list()
+
+    def submit(self, job):
+        self.submitted.append(job)
+        job.pid = len(self.submitted)
+
+    def update_many(self, jobs):
+        for job in jobs:
+            job.returncode = job._returncode
+
+def pipeline(*jobs):
+    jarray = JobArray(Executor())
+    pipeline = Pipeline(jarray, poll=0)
+    for job in jobs:
+        pipeline.add(job)
+    return pipeline
+
+def test_stages_run_after_their_jobs():
+    calls = list()
+    prequal,qsiprep = Job('prequal'), Job('qsiprep')
+    p = pipeline(prequal, qsiprep)
+    first = p.stage('prequal eddy quad', lambda: calls.append('prequal'), jobs=[prequal])
+    second = p.stage('qsiprep eddy quad', lambda: calls.append('qsiprep'), jobs=[qsiprep])
+    report = p.stage('report', lambda: calls.append('report'), after=[first, second], inline=True)
+    p.run()
+    assert calls[-1] == 'report'
+    assert sorted(calls) == ['prequal', 'qsiprep', 'report']
+    assert all(stage.ok for stage in (first, second, report))
+    assert not p.failed
+
+def test_failed_job_skips_downstream_stages():
+    calls = list()
+    prequal,qsiprep = Job('prequal', returncode=1), Job('qsiprep')
+    p = pipeline(prequal, qsiprep)
+    first = p.stage('prequal eddy quad', lambda: calls.append('prequal'), jobs=[prequal])
+    second = p.stage('qsiprep eddy quad', lambda: calls.append('qsiprep'), jobs=[qsiprep])
+    report = p.stage('report', lambda: calls.append('report'), after=[first, second])
+    p.run()
+    assert calls == ['qsiprep']
+    assert p.skipped == [first, report]
+    assert second.ok and not report.ok
+
+def test_failed_stage_skips_downstream_stages():
+    def fail():
+        raise RuntimeError('eddy quad failed')
+    job = Job('qsiprep')
+    p = pipeline(job)
+    first = p.stage('qsiprep eddy quad', fail, jobs=[job])
+    report = p.stage('report', lambda: None, after=[first])
+    p.run()
+    assert p.failed == [first]
+    assert p.skipped == [report]
+
+def test_limit_on_running_jobs():
+    jobs = [Job(f'job{i}') for i in range(3)]
+    p = pipeline(*jobs)
+    p.run(limit=1)
+    assert [job.pid for job in jobs] == [1, 2, 3]
+    assert len(p.jarray.complete) == 3
+
+def test_parents_pid():
+    jobs = [Job('prequal'), Job('qsiprep')]
+    jobs[0].pid,jobs[1].pid = 11, 12
+    assert Parents(jobs).pid == '11:12'
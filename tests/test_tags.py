@@ -0,0 +1,64 @@
+import re
+import pytest
+from dwiqc.tags import TagMatcher
+
+CONFIG = {
+    'dwi_main': {
+        'tag': [r'.*(^|\s)#dwi_main(?P<run>_\d+)?(\s|$).*']
+    },
+    'fmap_pa': {
+        'tag': [r'.*(^|\s)#dwi_fmap_pa(?P<run>_\d+)?(\s|$).*']
+    },
+    't1w': {
+        'tag': [
+            r'(?i).*(^|\s)#dwiqc_t1w(\s|$).*',
+            r'.*(^|\s)#t1w(?P<run>_\d+)?(\s|$).*'
+        ]
+    },
+    'untagged': {
+        'bids_subdir': ['anat']
+    }
+}
+
+def match(note, patterns):
+    '''
+    How every label was matched before the patterns were combined
+    '''
+    for pattern in patterns:
+        m = re.match(pattern, note, flags=re.IGNORECASE)
+        if m:
+            return m
+    return None
+
+@pytest.mark.parametrize('note', [
+    '#dwi_main_001',
+    '#DWI_MAIN_002 #dwi_fmap_pa_002',
+    'good scan #dwi_fmap_pa',
+    '#t1w_001',
+    '#DWIQC_T1w',
+    '#dwiqc_t1w #t1w_003',
+    '#dwi_main_001x',
+    'no tags here',
+    ''
+])
+def test_classify_matches_each_label_on_its_own(note):
+    expected = dict()
+    for label,conf in CONFIG.items():
+        if 'tag' not in conf:
+            continue
+        m = match(note, conf['tag'])
+        if m:
+            expected[label] = m.groupdict().get('run')
+    assert TagMatcher(CONFIG).classify(note) == expected
+
+def test_classify_returns_run():
+    tags = TagMatcher(CONFIG).classify('#dwi_main_002 #dwi_fmap_pa_002')
+    assert tags == {'dwi_main': '_002', 'fmap_pa': '_002'}
+
+def test_first_matching_pattern_wins():
+    # the first t1w pattern has no run group
+    assert TagMatcher(CONFIG).classify('#DWIQC_T1w #t1w_001') == {'t1w': None}
+
+def test_classify_is_cached():
+    matcher = TagMatcher(CONFIG)
+    assert matcher.classify('#t1w_001') is matcher.classify('#t1w_001')
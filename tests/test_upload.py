@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+import urllib.parse
+import pytest
+import yaxil
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dwiqc.upload import Uploader, UploadError, JOURNAL
+
+ASSESSMENT = '''<?xml version="1.0" encoding="UTF-8"?>
+<dwiqc:dwiqc xmlns:dwiqc="http://nrg.wustl.edu/dwiqc" xmlns:xnat="http://nrg.wustl.edu/xnat" ID="SESS01_DWI_25_DWIQC">
+  <xnat:imageSession_ID>XNAT_E00001</xnat:imageSession_ID>
+</dwiqc:dwiqc>
+'''
+
+class XNAT(BaseHTTPRequestHandler):
+    '''
+    Just enough of the XNAT REST API for an upload. Resource files listed
+    in the server's status map get that status code.
+    '''
+    def handle_request(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        url = urllib.parse.urlparse(self.path)
+        self.server.requests.append((self.command, url.path, dict(urllib.parse.parse_qsl(url.query))))
+        status = 200
+        if '/files/' in url.path:
+            status = self.server.status.get(url.path.split('/files/')[1], 200)
+        body = b'JSESSIONID' if url.path == '/data/JSESSION' else b''
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def xnat():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), XNAT)
+    server.requests = list()
+    server.status = dict()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def artifacts(tmp_path):
+    (tmp_path / 'assessor').mkdir()
+    (tmp_path / 'assessor' / 'assessment.xml').write_text(ASSESSMENT)
+    for resource,name,content in [('PREQUAL', 'report.pdf', b'pdf'), ('QSIPREP', 'report.html', b'html'), ('QSIPREP', 'dwi.png', b'png')]:
+        (tmp_path / 'resources' / resource).mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'resources' / resource / name).write_bytes(content)
+    return str(tmp_path)
+
+def uploader(xnat, artifacts, bundle=None):
+    auth = yaxil.XnatAuth(url=f'http://127.0.0.1:{xnat.server_port}', username='user', password='pass', cookie=dict())
+    return Uploader(auth, artifacts, 'dwiqc-resource', bundle=bundle)
+
+def files(xnat):
+    return {path.split('/files/')[1]: params for method,path,params in xnat.requests if method == 'PUT' and '/files/' in path}
+
+def journal(artifacts):
+    with open(os.path.join(artifacts, JOURNAL)) as fo:
+        return json.load(fo)
+
+def test_upload_overwrites_and_journals_files(xnat, artifacts):
+    uploader(xnat, artifacts).upload()
+    assert files(xnat) == {
+        'PREQUAL/report.pdf': {'overwrite': 'true'},
+        'QSIPREP/report.html': {'overwrite': 'true'},
+        'QSIPREP/dwi.png': {'overwrite': 'true'}
+    }
+    assert sorted(journal(artifacts)['files']) == ['PREQUAL/report.pdf', 'QSIPREP/dwi.png', 'QSIPREP/report.html']
+
+def test_upload_again_sends_nothing(xnat, artifacts):
+    uploader(xnat, artifacts).upload()
+    xnat.requests.clear()
+    uploader(xnat, artifacts).upload()
+    assert [path for _,path,_ in xnat.requests] == ['/data/JSESSION', '/data/JSESSION']
+
+def test_upload_changed_file(xnat, artifacts):
+    uploader(xnat, artifacts).upload()
+    xnat.requests.clear()
+    with open(os.path.join(artifacts, 'resources', 'QSIPREP', 'dwi.png'), 'wb') as fo:
+        fo.write(b'new png')
+    uploader(xnat, artifacts).upload()
+    assert list(files(xnat)) == ['QSIPREP/dwi.png']
+
+def test_conflict_is_not_journaled(xnat, artifacts):
+    xnat.status['QSIPREP/dwi.png'] = 409
+    with pytest.raises(UploadError):
+        uploader(xnat, artifacts).upload()
+    assert sorted(journal(artifacts)['files']) == ['PREQUAL/report.pdf', 'QSIPREP/report.html']
+    xnat.requests.clear()
+    xnat.status.clear()
+    uploader(xnat, artifacts).upload()
+    assert list(files(xnat)) == ['QSIPREP/dwi.png']
+
+def test_bundles_are_extracted_and_overwritten(xnat, artifacts):
+    uploader(xnat, artifacts, bundle='resource').upload()
+    assert files(xnat) == {
+        'PREQUAL.zip': {'overwrite': 'true', 'extract': 'true'},
+        'QSIPREP.zip': {'overwrite': 'true', 'extract': 'true'}
+    }
+    assert sorted(journal(artifacts)['files']) == ['PREQUAL.zip', 'QSIPREP.zip']